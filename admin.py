@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 import argparse
 import collections
+import concurrent.futures
 import getpass
 import json
 import logging
+import multiprocessing
 import os
+import sqlite3
 import sys
+import time
 import wand
 
-from jennabox.dao import DaoModule
+from jennabox.dao import DaoModule, OriginalMissing
 from jennabox.auth import AuthModule, random_password, input_password
 from jennabox.config import ServerModule
 from jennabox.domain import *
+from jennabox.ingest import apply_resource_limits, hash_file, import_image, ingest_image
+from jennabox.migrations import LATEST_VERSION, MIGRATIONS, current_version, migrate
 from xeno import *
 
 #--------------------------------------------------------------------
@@ -49,6 +55,52 @@ class Config:
         self.get_arg_parser().parse_known_args(namespace = self)
         return self
 
+#----------------------------------------------------------
+@cmap('migrate')
+class Migrate(Config):
+    """
+        Upgrade the database schema.  The server refuses to start on a
+        database which is behind, so run this after upgrading JennaBox.
+        Large libraries may take a while, as some migrations rebuild
+        the image_tags table.
+    """
+
+    def __init__(self, log, db_file):
+        self.log = log
+        self.db_file = db_file
+        self.parse_args()
+
+    def get_arg_parser(self):
+        parent = super().get_arg_parser()
+        parser = argparse.ArgumentParser(parents = [parent], prog = 'admin.py migrate')
+        parser.add_argument('-t', '--target', dest='target', type=int, default=LATEST_VERSION,
+                            help='Schema version to migrate to, defaults to the latest.')
+        parser.add_argument('-s', '--status', action='store_true',
+                            help='Only show the current schema version and pending migrations.')
+        return parser
+
+    def __call__(self):
+        db = sqlite3.connect(self.db_file)
+        try:
+            version = current_version(db)
+            pending = [m for m in MIGRATIONS if version < m.version <= self.target]
+            print('Schema version %d, latest is %d.' % (version, LATEST_VERSION))
+            if self.status:
+                for migration in pending:
+                    print('    pending %d: %s' % (migration.version, migration.description))
+                return
+            if not pending:
+                print('Nothing to migrate.')
+                return
+
+            for migration in pending:
+                start = time.perf_counter()
+                migrate(db, migration.version)
+                print('Applied %d: %s (%.2fs)' % (migration.version, migration.description,
+                                                  time.perf_counter() - start))
+        finally:
+            db.close()
+
 #----------------------------------------------------------
 @cmap('recover-missing-db-images')
 class RecoverMissingDbImages(Config):
@@ -57,68 +109,421 @@ class RecoverMissingDbImages(Config):
         self.image_dir = image_dir
         self.parse_args()
 
+    def get_arg_parser(self):
+        parent = super().get_arg_parser()
+        parser = argparse.ArgumentParser(parents = [parent], prog = 'admin.py recover-missing-db-images')
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='Report missing images without restoring them.')
+        return parser
+
     def __call__(self):
         image_dao = self.dao_factory.get_image_dao()
+        stored_filenames = image_dao.get_stored_filenames()
+        # Shared originals keep the name of the image first stored.
+        known_filenames = set(stored_filenames.values()) | image_dao.get_blob_filenames()
 
-        count = 0
-
+        images = []
         for id, mime_type in self.list_all_uploaded_image_ids():
-            image = image_dao.get(id)
-            if image is None:
-                print("Restoring image %s..." % id)
-                self.restore_lost_image(id, mime_type)
-                count += 1
+            if id not in stored_filenames and id + Image.MIME_EXT_MAP[mime_type] not in known_filenames:
+                print("%s image %s..." % ('Missing' if self.dry_run else 'Restoring', id))
+                images.append(self.make_lost_image(id, mime_type))
+                known_filenames.add(images[-1].get_filename())
+
+        if not self.dry_run:
+            image_dao.save_images(images)
+        print("%s %d images." % ('Found' if self.dry_run else 'Restored', len(images)))
 
-        print("Restored %d images." % count)
+        orphans = self.list_orphaned_thumbnails(known_filenames)
+        for filename in orphans:
+            print("Orphaned thumbnail mini/%s" % filename)
+        print("Found %d orphaned thumbnails." % len(orphans))
 
     def list_all_uploaded_image_ids(self):
         supported_image_exts = set(Image.MIME_EXT_MAP.values())
         ext_mime_map = {v: k for k, v in Image.MIME_EXT_MAP.items()}
 
-        for image_file in os.listdir(self.image_dir):
-            name, ext = os.path.splitext(image_file)
-            if ext in supported_image_exts:
-                mime_type = ext_mime_map[ext]
-                yield name, mime_type
-
-    def restore_lost_image(self, id, mime_type):
-        image_dao = self.dao_factory.get_image_dao()
+        with os.scandir(self.image_dir) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)
+                if ext in supported_image_exts and entry.is_file():
+                    mime_type = ext_mime_map[ext]
+                    yield name, mime_type
+
+    def list_orphaned_thumbnails(self, known_filenames):
+        mini_dir = os.path.join(self.image_dir, 'mini')
+        if not os.path.exists(mini_dir):
+            return []
+        with os.scandir(mini_dir) as entries:
+            return sorted(entry.name for entry in entries
+                          if entry.is_file() and entry.name not in known_filenames)
+
+    def make_lost_image(self, id, mime_type):
         image = Image(id = id, mime_type = mime_type,
             summary = "Image recovered from deletion.")
         image.add_tags(User.ALL, 'flag:recovered')
-        image_dao.save_image(image)
+        return image
 
 #----------------------------------------------------------
 @cmap('backfill-metadata')
 class BackfillMetadata(Config):
-    BATCH_SIZE = 5
+    BATCH_SIZE = 256
+    CHECKPOINT = 'backfill-metadata'
 
-    def __init__(self, dao_factory):
+    def __init__(self, dao_factory, imagemagick_limits):
         self.dao_factory = dao_factory
+        self.imagemagick_limits = imagemagick_limits
         self.parse_args()
 
+    def get_arg_parser(self):
+        parent = super().get_arg_parser()
+        parser = argparse.ArgumentParser(parents = [parent], prog = 'admin.py backfill-metadata')
+        parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                            help='Number of images to decode at once.')
+        parser.add_argument('-b', '--batch-size', dest='batch_size', type=int,
+                            default=BackfillMetadata.BATCH_SIZE,
+                            help='Number of images written per transaction.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore the checkpoint of an interrupted run.')
+        return parser
+
     def __call__(self):
         image_dao = self.dao_factory.get_image_dao()
-        images, total = image_dao.find([], [], limit = BackfillMetadata.BATCH_SIZE)
-        offset = 0
-
-        print('==> Scanning %d total images for metadata backfill.', total)
-        while offset < total:
+        after_id = None
+        if not self.restart:
+            after_id = image_dao.get_checkpoint(BackfillMetadata.CHECKPOINT)
+        if after_id is not None:
+            print('==> Resuming after image %s.' % after_id)
+
+        self.total = image_dao.count_images_after(after_id)
+        self.processed = 0
+        self.updated = 0
+        self.started = time.time()
+        print('==> Scanning %d images for metadata backfill with %d jobs.' % (self.total, self.jobs))
+
+        with concurrent.futures.ProcessPoolExecutor(
+                self.jobs, mp_context = multiprocessing.get_context('spawn'),
+                initializer = apply_resource_limits,
+                initargs = (self.imagemagick_limits,)) as executor:
+            # Decoding of the next batch overlaps writing of this one.
+            pending = None
+            while True:
+                image_ids = image_dao.get_image_ids_after(after_id, self.batch_size)
+                batch = self.submit(executor, image_dao, image_ids) if image_ids else None
+                if pending is not None:
+                    self.write(image_dao, *pending)
+                if batch is None:
+                    break
+                pending = batch
+                after_id = image_ids[-1]
+
+        image_dao.clear_checkpoint(BackfillMetadata.CHECKPOINT)
+        print('==> Done, updated tags on %d of %d images in %.1fs.' % (
+            self.updated, self.processed, time.time() - self.started))
+
+    def submit(self, executor, image_dao, image_ids):
+        images = image_dao.get_images(image_ids)
+        metadata_maps = image_dao.get_metadata_maps(image_ids)
+        futures = {image.id: executor.submit(ingest_image, image_dao.get_image_filenames(image)[0])
+                   for image in images if image.id not in metadata_maps}
+        return image_ids[-1], images, metadata_maps, futures
+
+    def write(self, image_dao, last_id, images, metadata_maps, futures):
+        # Wait for the decodes before starting the transaction, so that
+        # uploads aren't held up behind the writer.
+        results = {}
+        for image_id, future in futures.items():
+            try:
+                results[image_id] = future.result()
+            except Exception as e:
+                print('-> Failed to decode %s: %s' % (image_id, e))
+
+        def write_batch():
             for image in images:
-                print('-> Scanning %s... [%s]' % (image.id, ', '.join(sorted(list(image.tags)))))
                 original_tags = set(image.tags)
-                image.populate_from_metadata(image_dao.get_metadata(image))
+                metadata_map = metadata_maps.get(image.id)
+                if metadata_map is None:
+                    if image.id not in results:
+                        continue
+                    metadata_map = image_dao.save_ingest_result(image, results[image.id])
+
+                image.populate_from_metadata(metadata_map, image_dao.date_tags_enabled)
                 difference_set = image.tags - original_tags
                 if difference_set:
-                    print('\tAdding tags [%s]' % (', '.join(sorted(list(difference_set)))))
+                    print('-> %s: adding tags [%s]' % (image.id, ', '.join(sorted(list(difference_set)))))
                     image_dao.save_image(image)
+                    self.updated += 1
+
+            # The checkpoint commits with the batch, so a resumed run
+            # never skips an image which wasn't written.
+            image_dao.set_checkpoint(BackfillMetadata.CHECKPOINT, last_id)
 
-            print('==> Processed %d/%d images (%%%d)' % (
-                offset + len(images), total,
-                int(100 * float(offset + len(images)) / float(total))))
+        image_dao.batch(write_batch)
 
-            offset += len(images)
-            images, total = image_dao.find([], [], limit = BackfillMetadata.BATCH_SIZE, offset = offset)
+        self.processed += len(images)
+        elapsed = max(time.time() - self.started, 0.001)
+        print('==> Processed %d/%d images (%d%%), %.1f images/s, %d decoded in this batch.' % (
+            self.processed, self.total,
+            int(100 * float(self.processed) / float(max(self.total, 1))),
+            self.processed / elapsed, len(futures)))
+
+#----------------------------------------------------------
+@cmap('import')
+class Import(Config):
+    BATCH_SIZE = 256
+    CHECKPOINT = 'import:%s'
+
+    def __init__(self, dao_factory, imagemagick_limits):
+        self.dao_factory = dao_factory
+        self.imagemagick_limits = imagemagick_limits
+        self.parse_args()
+
+    def get_arg_parser(self):
+        parent = super().get_arg_parser()
+        parser = argparse.ArgumentParser(parents = [parent], prog = 'admin.py import')
+        parser.add_argument('source', metavar='DIRECTORY')
+        parser.add_argument('-u', '--username', metavar='USERNAME',
+                            help='Tag imported images as belonging to this user, instead of all users.')
+        parser.add_argument('-t', '--tag', dest='tags', metavar='TAG', action='append', default=[],
+                            help='Add a tag to every imported image.')
+        parser.add_argument('-d', '--dedupe', action='store_true',
+                            help='Skip images whose content is already stored.')
+        parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                            help='Number of images to process at once.')
+        parser.add_argument('-b', '--batch-size', dest='batch_size', type=int,
+                            default=Import.BATCH_SIZE,
+                            help='Number of images written per transaction.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore the checkpoint of an interrupted import.')
+        return parser
+
+    def __call__(self):
+        image_dao = self.dao_factory.get_image_dao()
+        self.source = os.path.abspath(self.source)
+        self.checkpoint = Import.CHECKPOINT % self.source
+        after = None if self.restart else image_dao.get_checkpoint(self.checkpoint)
+
+        # Paths are imported in sorted order, so the checkpoint is the
+        # last path written.
+        paths = [path for path in self.list_source_images() if after is None or path > after]
+        if after is not None:
+            print('==> Resuming after %s.' % after)
+
+        self.total = len(paths)
+        self.imported = 0
+        self.linked = 0
+        self.skipped = 0
+        self.failed = 0
+        self.seen = set()
+        # Content whose first copy in this run failed to import.
+        self.failed_hashes = set()
+        self.started = time.time()
+        print('==> Importing %d images from %s with %d jobs.' % (self.total, self.source, self.jobs))
+
+        with concurrent.futures.ProcessPoolExecutor(
+                self.jobs, mp_context = multiprocessing.get_context('spawn'),
+                initializer = apply_resource_limits,
+                initargs = (self.imagemagick_limits,)) as executor:
+            # Decoding of the next batch overlaps writing of this one.
+            pending = None
+            for n in range(0, len(paths) + self.batch_size, self.batch_size):
+                batch_paths = paths[n:n + self.batch_size]
+                batch = self.submit(executor, image_dao, batch_paths) if batch_paths else None
+                if pending is not None:
+                    self.write(image_dao, *pending)
+                if batch is None:
+                    break
+                pending = batch
+
+        image_dao.clear_checkpoint(self.checkpoint)
+        print('==> Done, imported %d images (%d sharing stored originals, %d duplicates skipped, %d failed) in %.1fs.' % (
+            self.imported, self.linked, self.skipped, self.failed, time.time() - self.started))
+
+    def list_source_images(self):
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(self.source):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() in Image.EXT_MIME_MAP:
+                    paths.append(os.path.relpath(os.path.join(dirpath, filename), self.source))
+        return sorted(paths)
+
+    def make_image(self, path):
+        image = Image(mime_type = Image.EXT_MIME_MAP[os.path.splitext(path)[1].lower()],
+                      summary = 'Imported from %s.' % path)
+        if self.username is not None:
+            image.add_tags(User(self.username).get_tag())
+        else:
+            image.add_tags(User.ALL)
+        image.add_tags(*self.tags)
+        return image
+
+    def submit(self, executor, image_dao, paths):
+        sources = [os.path.join(self.source, path) for path in paths]
+        jobs = []
+        for path, source, blob_hash in zip(paths, sources, executor.map(hash_file, sources)):
+            duplicate = blob_hash in self.seen or image_dao.has_blob(blob_hash)
+            self.seen.add(blob_hash)
+            if duplicate and self.dedupe:
+                jobs.append((path, source, None, blob_hash, None))
+                continue
+
+            image = self.make_image(path)
+            future = None
+            if not duplicate:
+                image_filename, mini_filename = image_dao.get_image_filenames(image)
+                future = executor.submit(import_image, source, image_filename, mini_filename,
+                                         *image_dao.get_animation_filenames(image))
+            jobs.append((path, source, image, blob_hash, future))
+        return paths[-1], jobs
+
+    def write(self, image_dao, last_path, jobs):
+        # Wait for the imports before starting the transaction, so that
+        # uploads aren't held up behind the writer.
+        results = []
+        for path, source, image, blob_hash, future in jobs:
+            result = None
+            try:
+                if future is not None:
+                    result = future.result()
+                elif blob_hash in self.failed_hashes:
+                    # The first copy of this content failed, so this
+                    # copy is imported in its place.
+                    image = image or self.make_image(path)
+                    result = import_image(source, *self.own_files(image_dao, image))
+            except Exception as e:
+                print('-> Failed to import %s: %s' % (path, e))
+                self.remove_files(self.own_files(image_dao, image))
+                self.failed_hashes.add(blob_hash)
+                self.failed += 1
+                continue
+
+            if image is None:
+                self.skipped += 1
+                continue
+            if result is not None:
+                self.failed_hashes.discard(blob_hash)
+            results.append((path, source, image, blob_hash, result))
+
+        missing = self.write_results(image_dao, last_path, results)
+        if missing:
+            # The stored originals these were to share were deleted
+            # after they were hashed, so they are imported themselves.
+            self.write_results(image_dao, last_path, self.import_missing(image_dao, missing))
+
+        processed = self.imported + self.skipped + self.failed
+        elapsed = max(time.time() - self.started, 0.001)
+        print('==> Processed %d/%d images (%d%%), %.1f images/s.' % (
+            processed, self.total, int(100 * float(processed) / float(max(self.total, 1))),
+            processed / elapsed))
+
+    def write_results(self, image_dao, last_path, results):
+        """
+            Save a batch of imported images in one transaction.
+            Returns those whose stored original was deleted, which
+            weren't written.
+        """
+        copies = []
+        missing = []
+
+        def write_batch():
+            for path, source, image, blob_hash, result in results:
+                # A duplicate is pointed at the stored original's files.
+                own_files = self.own_files(image_dao, image)
+                try:
+                    duplicate = image_dao.save_imported_image(image, blob_hash, result)
+                except OriginalMissing:
+                    missing.append((path, source, image, blob_hash, result))
+                    continue
+                if duplicate:
+                    self.linked += 1
+                    if result is not None:
+                        # The same content was stored after it was hashed.
+                        copies.extend(own_files)
+                self.imported += 1
+
+            # The checkpoint commits with the batch, so a resumed import
+            # never skips an image which wasn't written.
+            if not missing:
+                image_dao.set_checkpoint(self.checkpoint, last_path)
+
+        image_dao.batch(write_batch)
+        self.remove_files(copies)
+        return missing
+
+    def import_missing(self, image_dao, missing):
+        results = []
+        for path, source, image, blob_hash, _ in missing:
+            try:
+                result = import_image(source, *self.own_files(image_dao, image))
+            except Exception as e:
+                print('-> Failed to import %s: %s' % (path, e))
+                self.remove_files(self.own_files(image_dao, image))
+                self.failed += 1
+                continue
+            results.append((path, source, image, blob_hash, result))
+        return results
+
+    def own_files(self, image_dao, image):
+        return image_dao.get_image_filenames(image) + image_dao.get_animation_filenames(image)
+
+    def remove_files(self, filenames):
+        for filename in filenames:
+            if filename is not None and os.path.exists(filename):
+                os.remove(filename)
+
+#----------------------------------------------------------
+@cmap('dedupe')
+class Dedupe(Config):
+    def __init__(self, dao_factory):
+        self.dao_factory = dao_factory
+        self.parse_args()
+
+    def get_arg_parser(self):
+        parent = super().get_arg_parser()
+        parser = argparse.ArgumentParser(parents = [parent], prog = 'admin.py dedupe')
+        parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                            help='Number of originals to hash at once.')
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='Report duplicates without linking or removing anything.')
+        return parser
+
+    def __call__(self):
+        image_dao = self.dao_factory.get_image_dao()
+        image_ids = image_dao.get_unlinked_image_ids()
+        seen = set()
+        count = 0
+        reclaimed = 0
+
+        print('==> Hashing %d images with %d jobs.' % (len(image_ids), self.jobs))
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            # Oldest images are linked first, so they keep their files.
+            images = image_dao.get_images(image_ids)
+            filenames = [image_dao.get_image_filenames(image)[0] for image in images]
+            hashes = executor.map(self.hash_image, filenames)
+
+            for image, image_filename, blob_hash in zip(images, filenames, hashes):
+                if blob_hash is None:
+                    print('-> Skipping %s, its original is missing.' % image.id)
+                    continue
+
+                size = os.path.getsize(image_filename)
+                if self.dry_run:
+                    duplicate = blob_hash in seen or image_dao.has_blob(blob_hash)
+                    seen.add(blob_hash)
+                else:
+                    duplicate = image_dao.link_existing_image(image, blob_hash)
+
+                if duplicate:
+                    print('-> %s is a duplicate (%d bytes).' % (image.id, size))
+                    count += 1
+                    reclaimed += size
+
+        print('==> Found %d duplicate images, %s%d bytes.' % (
+            count, 'could reclaim ' if self.dry_run else 'reclaimed ', reclaimed))
+
+    def hash_image(self, image_filename):
+        if not os.path.exists(image_filename):
+            return None
+        return hash_file(image_filename)
 
 #----------------------------------------------------------
 @cmap('dump-metadata')
@@ -132,6 +537,8 @@ class DumpMetadata(Config):
         parser = argparse.ArgumentParser(parents = [parent], prog = 'admin.py dump-metadata')
         parser.add_argument('-i', '--image', dest='image_id',
                             metavar='IMAGE_ID', required=True)
+        parser.add_argument('-r', '--refresh', action='store_true',
+                            help='Decode the original image again and store its metadata.')
         return parser
 
     def __call__(self):
@@ -139,9 +546,53 @@ class DumpMetadata(Config):
         image = image_dao.get(self.image_id)
         if image is None:
             raise Exception('No image with id "%s" exists.' % self.image_id)
-        metadata_map = image_dao.get_metadata(image)
+        if self.refresh:
+            metadata_map = image_dao.refresh_metadata(image)
+        else:
+            metadata_map = image_dao.get_metadata(image)
         print(json.dumps(metadata_map, indent=4))
 
+#----------------------------------------------------------
+@cmap('tag-stats')
+class TagStats(Config):
+    def __init__(self, dao_factory):
+        self.dao_factory = dao_factory
+        self.parse_args()
+
+    def get_arg_parser(self):
+        parent = super().get_arg_parser()
+        parser = argparse.ArgumentParser(parents = [parent], prog = 'admin.py tag-stats')
+        parser.add_argument('-n', '--limit', dest='limit', type=int, default=50,
+                            help='Number of tags to show, most used first.  0 shows all tags.')
+        return parser
+
+    def __call__(self):
+        image_dao = self.dao_factory.get_image_dao()
+        total = image_dao.count_images_after(None)
+        tag_stats = image_dao.get_tag_stats(self.limit or None)
+        print('%-40s %10s %8s' % ('tag', 'images', 'share'))
+        for tag, image_count in tag_stats:
+            print('%-40s %10d %7.1f%%' % (tag, image_count, 100.0 * image_count / max(total, 1)))
+        print('==> %d images.' % total)
+
+#----------------------------------------------------------
+@cmap('rebuild-text-index')
+class RebuildTextIndex(Config):
+    def __init__(self, dao_factory):
+        self.dao_factory = dao_factory
+        self.parse_args()
+
+    def get_arg_parser(self):
+        parent = super().get_arg_parser()
+        return argparse.ArgumentParser(parents = [parent], prog = 'admin.py rebuild-text-index')
+
+    def __call__(self):
+        image_dao = self.dao_factory.get_image_dao()
+        start = time.time()
+        image_dao.rebuild_text_index()
+        print('Text index of %d images rebuilt in %.2f seconds.' % (
+            image_dao.count_images_after(None), time.time() - start))
+
 #----------------------------------------------------------
 @cmap('delete-image')
 class DeleteImage(Config):
@@ -181,6 +632,8 @@ class AddUser(Config):
     def __call__(self):
         password = None
         user_dao = self.dao_factory.get_user_dao()
+        if user_dao.get(self.username) is not None:
+            raise UsernameTaken(self.username)
         user = User(
             username = self.username,
             rights = ([UserRight.USER] +
@@ -231,6 +684,8 @@ class ResetPassword(Config):
 
         user.passhash = self.auth.encrypt_password(passwordA)
         user_dao.put(user)
+        # Revoke signed login tokens issued with the old password.
+        user_dao.bump_login_generation(user)
 
         print('Password changed successfully.')
 
@@ -13,6 +13,16 @@
       $('[data-textarea-content]').each(function(idx, element) {
          $(element).val($(element).data('textarea-content'));
       });
+
+      // Animated images show a static thumbnail until hovered.
+      $('img[data-preview]').each(function(idx, element) {
+         var still = $(element).attr('src');
+         $(element).hover(function() {
+            $(element).attr('src', $(element).data('preview'));
+         }, function() {
+            $(element).attr('src', still);
+         });
+      });
    });
    
    angular.module('JennaBox', [])
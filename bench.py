@@ -0,0 +1,730 @@
+#!/usr/bin/env python3
+#--------------------------------------------------------------------
+# JennaBox: A lightweight privacy-focused image tagging and
+#           sharing website.
+#
+# Benchmarks for JennaBox performance work, run against a synthetic
+# library so that results are comparable between revisions.
+#--------------------------------------------------------------------
+import argparse
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+from indenti import html
+from passlib.hash import bcrypt
+
+from jennabox.auth import LoginSigner, PasswordHasher, PasswordHasherBusy
+from jennabox.cache import UserCache
+from jennabox.config import ServerModule
+from jennabox.content import Header, LeftNav, Page
+from jennabox.domain import Login, User, UserRight
+from jennabox.framework import FragmentCache
+from jennabox.index import TagIndex
+from jennabox.migrations import LATEST_VERSION, migrate
+from jennabox.query import Cursor, SortOrder, parse_query, tag_list_query, tag_query_compiler
+
+#--------------------------------------------------------------------
+class ClassMap(collections.UserDict):
+    def commands(self):
+        return sorted(list(self.keys()))
+
+    def __call__(self, name = None):
+        def define_impl(f):
+            n = name
+            if name is None:
+                n = f.__name__
+            self.data[n] = f
+            return f
+        return define_impl
+
+cmap = ClassMap()
+
+#--------------------------------------------------------------------
+class Config:
+    def get_arg_parser(self):
+        parser = argparse.ArgumentParser(description = 'Benchmarks for JennaBox.',
+                add_help = False)
+        parser.add_argument('command', metavar='COMMAND', nargs='?', default=None)
+        parser.add_argument('-n', '--images', dest='image_count', type=int, default=20000)
+        parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=5)
+        parser.add_argument('--seed', dest='seed', type=int, default=1)
+        return parser
+
+    def parse_args(self):
+        self.get_arg_parser().parse_known_args(namespace = self)
+        return self
+
+#--------------------------------------------------------------------
+class SyntheticLibrary:
+    """
+        A throwaway sqlite database populated with images and a skewed
+        tag distribution resembling a real JennaBox library.
+    """
+
+    USERS = ['jenna', 'lain', 'mom', 'dad', 'guest-uploader']
+    WORDS = ['beach', 'cat', 'dog', 'birthday', 'christmas', 'hike', 'food',
+             'sunset', 'family', 'car', 'garden', 'snow', 'museum', 'concert']
+    FILLER = ['a', 'the', 'with', 'our', 'at', 'after', 'day', 'trip', 'visit',
+              'weekend', 'morning', 'evening', 'first', 'last', 'new', 'old',
+              'lovely', 'rainy', 'sunny', 'party', 'friends', 'everyone', 'home']
+
+    def __init__(self, image_count, seed = 1, schema_version = None):
+        self.image_count = image_count
+        self.random = random.Random(seed)
+        # Kept separate so that summaries don't change the tags drawn.
+        self.text_random = random.Random(seed)
+        self.dir = tempfile.mkdtemp(prefix = 'jennabox-bench-')
+        self.db_file = os.path.join(self.dir, 'bench.sqlite3')
+        self.db = sqlite3.connect(self.db_file)
+        migrate(self.db, schema_version)
+        self.populate()
+
+    def random_tags(self, ts):
+        rnd = self.random
+        tags = {'user:%s' % rnd.choice(SyntheticLibrary.USERS),
+                'date:%d' % ts.year,
+                'date:%02d-%d' % (ts.month, ts.year)}
+        if rnd.random() < 0.8:
+            tags.add('public')
+        if rnd.random() < 0.02:
+            tags.add('flag:missing-exif-datetime')
+        for _ in range(rnd.randint(0, 4)):
+            # Zipf-ish: earlier words are much more common.
+            tags.add(SyntheticLibrary.WORDS[min(int(rnd.expovariate(0.35)), len(SyntheticLibrary.WORDS) - 1)])
+        return tags
+
+    def random_summary(self, tags):
+        rnd = self.text_random
+        words = [rnd.choice(SyntheticLibrary.FILLER) for _ in range(rnd.randint(3, 12))]
+        words.extend(tag for tag in tags if tag in SyntheticLibrary.WORDS)
+        rnd.shuffle(words)
+        return ' '.join(words).capitalize() + '.'
+
+    def populate(self):
+        start = datetime(2010, 1, 1)
+        step = timedelta(days = 3650) / max(self.image_count, 1)
+        image_rows = []
+        tag_rows = []
+        for n in range(self.image_count):
+            ts = start + step * n
+            id = '%032x' % self.random.getrandbits(128)
+            tags = self.random_tags(ts)
+            image_rows.append((id, 'image/jpeg', self.random_summary(tags), ts, ts))
+            tag_rows.extend((id, tag) for tag in tags)
+        self.db.executemany('insert into images(id, mime_type, summary, ts, create_ts) values(?, ?, ?, ?, ?)', image_rows)
+        self.db.executemany('insert into image_tags(id, tag) values(?, ?)', tag_rows)
+        self.db.commit()
+        self.db.execute('analyze')
+
+    def close(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+#--------------------------------------------------------------------
+def time_call(f, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+#--------------------------------------------------------------------
+class LegacyTagQueryBuilder:
+    """
+        The original per-tag subquery builder from SqliteImageDao,
+        kept as the baseline for the tag query regression benchmark.
+    """
+
+    def find(self, db, tags, ntags, limit, offset):
+        c = db.cursor()
+        c.execute(self._build_select_count_query(tags, ntags), tags + ntags)
+        count = c.fetchone()[0]
+        c.execute(self._build_select_query(tags, ntags, limit, offset), tags + ntags)
+        return [x[0] for x in c.fetchall()], count
+
+    def _build_select_count_query(self, tags, ntags):
+        query = 'select count(*) from images where {tag_queries} and {ntag_queries}'
+        return query.format(
+            tag_queries = self._build_tag_subquery(tags),
+            ntag_queries = self._build_tag_subquery(ntags, eq = False))
+
+    def _build_select_query(self, tags, ntags, limit, offset):
+        query = 'select id from images where {tag_queries} and {ntag_queries} order by images.ts desc limit %d offset %d' % (limit, offset)
+        return query.format(
+            tag_queries = self._build_tag_subquery(tags),
+            ntag_queries = self._build_tag_subquery(ntags, eq = False))
+
+    def _build_tag_subquery(self, tags, eq = True):
+        if not tags:
+            return '1'
+
+        if eq:
+            subquery = 'id in ({subselect})'
+        else:
+            subquery = 'id not in ({subselect})'
+
+        return ' and '.join(subquery.format(
+            subselect = 'select id from image_tags where tag collate nocase = ?') for tag in tags)
+
+#--------------------------------------------------------------------
+def compiled_find(db, query, limit, offset, sort = SortOrder.UPLOADED):
+    c = db.cursor()
+    counts = tag_query_compiler.get_counts(c, query)
+    if query.estimate(counts) == 0:
+        return [], 0
+    sql, params = tag_query_compiler.compile_select(query, counts, sort)
+    c.execute(sql, params + tag_query_compiler.page_params(limit, offset))
+    rows = c.fetchall()
+    if rows:
+        return [row[0] for row in rows], rows[0][1]
+    c.execute(*tag_query_compiler.compile_count(query, counts))
+    return [], c.fetchone()[0]
+
+#----------------------------------------------------------
+@cmap('tag-query')
+class TagQueryBenchmark(Config):
+    QUERIES = [
+        (['public'], []),
+        (['public', 'date:2016'], []),
+        (['public', 'date:2016', 'user:jenna'], []),
+        (['public', 'date:2016', 'user:jenna', 'beach'], []),
+        (['public', 'date:2016', 'user:jenna', 'beach', 'cat'], []),
+        (['public', 'date:2016', 'user:jenna', 'beach', 'cat', 'dog'], []),
+        (['public', 'user:jenna'], ['flag:missing-exif-datetime', 'cat']),
+        ([], ['public']),
+        (['public', 'no-such-tag'], []),
+    ]
+
+    def __init__(self):
+        self.parse_args()
+
+    def __call__(self):
+        library = SyntheticLibrary(self.image_count, self.seed)
+        legacy = LegacyTagQueryBuilder()
+        try:
+            print('==> %d images, best of %d runs.' % (self.image_count, self.repeat))
+            print('%-60s %10s %10s %8s' % ('query', 'legacy ms', 'single ms', 'speedup'))
+            for tags, ntags in TagQueryBenchmark.QUERIES:
+                query = tag_list_query(tags, ntags)
+                for offset in (0, 120):
+                    legacy_time, legacy_result = time_call(
+                        lambda: legacy.find(library.db, tags, ntags, 12, offset), self.repeat)
+                    compiled_time, compiled_result = time_call(
+                        lambda: compiled_find(library.db, query, 12, offset), self.repeat)
+                    if legacy_result != compiled_result:
+                        raise Exception('Result mismatch for %r -%r offset %d' % (tags, ntags, offset))
+                    label = ' '.join(tags + ['-' + tag for tag in ntags]) + ' @%d' % offset
+                    print('%-60s %10.2f %10.2f %7.1fx' % (
+                        label, legacy_time * 1000, compiled_time * 1000,
+                        legacy_time / compiled_time))
+        finally:
+            library.close()
+
+#----------------------------------------------------------
+@cmap('tag-index')
+class TagIndexBenchmark(Config):
+    QUERIES = [
+        'date:2016 or date:2017',
+        'public (date:2016 or date:2017) -(cat or dog)',
+        'user:*',
+        'public date:*-2016 user:jenna',
+        'user:j* -public',
+        'date:0*-201* beach',
+    ]
+
+    def __init__(self):
+        self.parse_args()
+
+    def __call__(self):
+        library = SyntheticLibrary(self.image_count, self.seed)
+        tag_index = TagIndex()
+        try:
+            rebuild_time, _ = time_call(lambda: tag_index.rebuild(library.db), 1)
+            print('==> %d images, index rebuilt in %.2f ms, best of %d runs.' % (
+                self.image_count, rebuild_time * 1000, self.repeat))
+            print('%-60s %10s %10s %8s' % ('query', 'sqlite ms', 'index ms', 'speedup'))
+            queries = [tag_list_query(tags, ntags) for tags, ntags in TagQueryBenchmark.QUERIES]
+            queries.extend(parse_query(text) for text in TagIndexBenchmark.QUERIES)
+            for query in queries:
+                for offset in (0, 120):
+                    sql_time, sql_result = time_call(
+                        lambda: compiled_find(library.db, query, 12, offset), self.repeat)
+                    index_time, index_result = time_call(
+                        lambda: tag_index.find(library.db, query, 12, offset), self.repeat)
+                    if sql_result != index_result:
+                        raise Exception('Result mismatch for %s offset %d' % (query, offset))
+                    label = '%s @%d' % (query, offset)
+                    print('%-60s %10.2f %10.2f %7.1fx' % (
+                        label[:60], sql_time * 1000, index_time * 1000,
+                        sql_time / index_time))
+        finally:
+            library.close()
+
+#----------------------------------------------------------
+@cmap('date-range')
+class DateRangeBenchmark(Config):
+    """
+        Compare filtering by the synthetic date: tags with filtering
+        by range on create_ts.
+    """
+
+    QUERIES = [
+        ('date:2016', 'after:2016 before:2017'),
+        ('date:03-2016', 'after:2016-03 before:2016-04'),
+        ('public date:2016 user:jenna', 'public after:2016 before:2017 user:jenna'),
+        ('date:2015 or date:2016', 'after:2015 before:2017'),
+        ('date:11-2015 or date:12-2015 or date:01-2016 or date:02-2016', 'after:2015-11 before:2016-03'),
+        ('public -date:2016', 'public -(after:2016 before:2017)'),
+    ]
+
+    def __init__(self):
+        self.parse_args()
+
+    def __call__(self):
+        library = SyntheticLibrary(self.image_count, self.seed)
+        try:
+            date_tags, = library.db.execute("select count(*) from image_tags where tag >= 'date:' and tag < 'date;'").fetchone()
+            tags, = library.db.execute('select count(*) from image_tags').fetchone()
+            print('==> %d images, %d of %d tag rows are date tags, best of %d runs.' % (
+                self.image_count, date_tags, tags, self.repeat))
+            print('%-60s %10s %10s %8s' % ('query', 'tags ms', 'range ms', 'speedup'))
+            for tag_text, range_text in DateRangeBenchmark.QUERIES:
+                tag_query, range_query = parse_query(tag_text), parse_query(range_text)
+                for offset in (0, 120):
+                    tag_time, tag_result = time_call(
+                        lambda: compiled_find(library.db, tag_query, 12, offset), self.repeat)
+                    range_time, range_result = time_call(
+                        lambda: compiled_find(library.db, range_query, 12, offset), self.repeat)
+                    if tag_result != range_result:
+                        raise Exception('Result mismatch for %s offset %d' % (range_text, offset))
+                    print('%-60s %10.2f %10.2f %7.1fx' % (
+                        ('%s @%d' % (range_text, offset))[:60], tag_time * 1000, range_time * 1000,
+                        tag_time / range_time))
+        finally:
+            library.close()
+
+#----------------------------------------------------------
+@cmap('text-search')
+class TextSearchBenchmark(Config):
+    """
+        Measure building the full-text index of image summaries and
+        searching it, and check that tag searches are no slower once
+        the index exists.
+    """
+
+    TEXT_INDEX_VERSION = 9
+
+    TAG_QUERIES = [
+        'public user:jenna -cat',
+        'public date:2016 beach',
+        '(date:2016 or date:2017) user:jenna -(cat or dog)',
+        'user:j* -public',
+    ]
+
+    TEXT_QUERIES = [
+        '"beach"',
+        '"beach sunset"',
+        '"rainy museum" public',
+        '"birthday" public user:jenna -cat',
+        '"snow*" -"christmas" date:2016',
+        '"concert" or museum',
+        '"the"',
+        '"no-such-word"',
+    ]
+
+    def __init__(self):
+        self.parse_args()
+
+    def __call__(self):
+        library = SyntheticLibrary(self.image_count, self.seed,
+                                   schema_version = TextSearchBenchmark.TEXT_INDEX_VERSION - 1)
+        try:
+            tag_queries = [parse_query(text) for text in TextSearchBenchmark.TAG_QUERIES]
+            before = [time_call(lambda: compiled_find(library.db, query, 12, 0), self.repeat)
+                      for query in tag_queries]
+            size_before = self.database_size(library.db)
+            build_time, _ = time_call(lambda: migrate(library.db, TextSearchBenchmark.TEXT_INDEX_VERSION), 1)
+            print('==> %d images, text index built in %.2f ms using %.1f MiB, best of %d runs.' % (
+                self.image_count, build_time * 1000,
+                (self.database_size(library.db) - size_before) / (1024.0 * 1024.0), self.repeat))
+
+            print('%-60s %10s %10s %8s' % ('tag query', 'before ms', 'after ms', 'ratio'))
+            for query, (before_time, before_result) in zip(tag_queries, before):
+                after_time, after_result = time_call(
+                    lambda: compiled_find(library.db, query, 12, 0), self.repeat)
+                if before_result != after_result:
+                    raise Exception('Result mismatch for %s' % query)
+                print('%-60s %10.2f %10.2f %7.2fx' % (
+                    str(query)[:60], before_time * 1000, after_time * 1000, after_time / before_time))
+
+            print('%-60s %10s %10s %8s' % ('text query', 'newest ms', 'ranked ms', 'images'))
+            for text in TextSearchBenchmark.TEXT_QUERIES:
+                query = parse_query(text)
+                for offset in (0, 120):
+                    newest_time, (_, count) = time_call(
+                        lambda: compiled_find(library.db, query, 12, offset), self.repeat)
+                    ranked_time, _ = time_call(
+                        lambda: compiled_find(library.db, query, 12, offset, SortOrder.RELEVANCE), self.repeat)
+                    print('%-60s %10.2f %10.2f %8d' % (
+                        ('%s @%d' % (text, offset))[:60], newest_time * 1000, ranked_time * 1000, count))
+        finally:
+            library.close()
+
+    def database_size(self, db):
+        return db.execute('pragma page_count').fetchone()[0] * db.execute('pragma page_size').fetchone()[0]
+
+#----------------------------------------------------------
+@cmap('login-tokens')
+class LoginTokenBenchmark(Config):
+    """
+        Compare checking a login per request by looking its token up in
+        the login dao's dict with verifying a signed token, alone and
+        with the check of the user's login generation.
+    """
+
+    LOOKUPS = 10000
+
+    def __init__(self):
+        self.parse_args()
+
+    def __call__(self):
+        expiry = datetime.now() + timedelta(days = 1)
+        logins = {}
+        for n in range(self.image_count):
+            login = Login('user%d' % (n % 100), expiry)
+            logins[login.token] = login
+        tokens = random.Random(self.seed).sample(list(logins), min(LoginTokenBenchmark.LOOKUPS, len(logins)))
+
+        signer = LoginSigner(os.urandom(32))
+        user_cache = UserCache(256, 30)
+        for n in range(100):
+            user_cache.put('user%d' % n, user_cache.generation, User('user%d' % n))
+
+        sign_time, signed = time_call(lambda: [signer.sign(logins[token], 0) for token in tokens], self.repeat)
+        dict_time, _ = time_call(lambda: [logins.get(token).is_valid() for token in tokens], self.repeat)
+        verify_time, _ = time_call(lambda: [signer.verify(token).is_valid() for token in signed], self.repeat)
+
+        def verify_with_generation():
+            for token in signed:
+                login = signer.verify(token)
+                login.is_valid() and user_cache.get(login.username).login_generation == login.generation
+        generation_time, _ = time_call(verify_with_generation, self.repeat)
+
+        print('==> %d logins, %d lookups, best of %d runs.' % (len(logins), len(tokens), self.repeat))
+        for label, elapsed in (('dict lookup', dict_time), ('sign token', sign_time),
+                               ('verify token', verify_time), ('verify token and generation', generation_time)):
+            print('%-40s %10.2f us' % (label, elapsed * 1000000 / len(tokens)))
+
+#----------------------------------------------------------
+@cmap('login-burst')
+class LoginBurstBenchmark(Config):
+    """
+        Send a burst of logins alongside a steady stream of image
+        browsing requests to a request thread pool the size of
+        CherryPy's, verifying passwords inline on the request threads
+        and then on the PasswordHasher, and compare browsing latency
+        and login throughput.
+    """
+
+    REQUEST_THREADS = 10
+    LOGINS = 40
+    BROWSES = 200
+    BROWSE_INTERVAL = 0.005
+    BROWSE_TIME = 0.002
+
+    def __init__(self):
+        self.parse_args()
+
+    def get_arg_parser(self):
+        parent = super().get_arg_parser()
+        parser = argparse.ArgumentParser(parents = [parent], prog = 'bench.py login-burst')
+        parser.add_argument('--rounds', dest='rounds', type=int, default=12)
+        parser.add_argument('--hash-workers', dest='hash_workers', type=int, default=2)
+        parser.add_argument('--hash-queue', dest='hash_queue', type=int, default=4)
+        return parser
+
+    def __call__(self):
+        handler = bcrypt.using(rounds = self.rounds)
+        passhash = handler.hash('password')
+        hasher = PasswordHasher(self.rounds, self.hash_workers, self.hash_queue)
+
+        def hasher_login():
+            try:
+                return hasher.verify('password', passhash)
+            except PasswordHasherBusy:
+                return None
+
+        print('==> %d logins at 2^%d rounds and %d browsing requests on %d request threads.' % (
+            LoginBurstBenchmark.LOGINS, self.rounds, LoginBurstBenchmark.BROWSES,
+            LoginBurstBenchmark.REQUEST_THREADS))
+        print('%-40s %8s %8s %8s %8s %8s %10s' % (
+            'verification', 'p50 ms', 'p95 ms', 'max ms', 'logins', '503s', 'logins/s'))
+        try:
+            self.report('inline on request threads', lambda: handler.verify('password', passhash))
+            self.report('password hasher (%d workers, %d queued)' % (self.hash_workers, self.hash_queue),
+                        hasher_login)
+        finally:
+            hasher.shutdown()
+
+    def report(self, label, login):
+        pool = concurrent.futures.ThreadPoolExecutor(LoginBurstBenchmark.REQUEST_THREADS)
+
+        def submit(request):
+            submitted = time.perf_counter()
+            def timed():
+                result = request()
+                return time.perf_counter() - submitted, result
+            return pool.submit(timed)
+
+        try:
+            logins = [submit(login) for _ in range(LoginBurstBenchmark.LOGINS)]
+            browses = []
+            for _ in range(LoginBurstBenchmark.BROWSES):
+                browses.append(submit(lambda: time.sleep(LoginBurstBenchmark.BROWSE_TIME)))
+                time.sleep(LoginBurstBenchmark.BROWSE_INTERVAL)
+
+            latencies = sorted(future.result()[0] for future in browses)
+            results = [future.result() for future in logins]
+            logged_in = sum(1 for _, result in results if result)
+            logins_done = max(elapsed for elapsed, _ in results)
+        finally:
+            pool.shutdown()
+
+        print('%-40s %8.1f %8.1f %8.1f %8d %8d %10.1f' % (
+            label, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000,
+            latencies[-1] * 1000, logged_in, len(results) - logged_in, logged_in / logins_done))
+
+#----------------------------------------------------------
+class UncachedFragments(FragmentCache):
+    """
+        Renders fragments into the page tree as before fragment
+        caching, keeping the render time breakdown.
+    """
+
+    def __init__(self):
+        super().__init__(0, 0)
+
+    def render(self, renderer):
+        started = time.perf_counter()
+        result = renderer.render()
+        self.local.timings.fragment(type(renderer).__name__).record(time.perf_counter() - started)
+        return result
+
+#----------------------------------------------------------
+BenchImage = collections.namedtuple('BenchImage', ['id', 'tags'])
+
+#----------------------------------------------------------
+class BenchAuth:
+    def __init__(self, user):
+        self.user = user
+
+    def get_user(self):
+        return self.user
+
+#----------------------------------------------------------
+class BenchPage(Page):
+    """
+        A page of search results like ImageSearchPage's, without the
+        search.
+    """
+
+    def __init__(self, images):
+        self.images = images
+
+    def content(self):
+        self.nav.set_tags_from_images(self.images)
+        row = html.div({'class': 'row'})
+        for n, image in enumerate(self.images):
+            row(html.div({'class': 'col-md-3 image-result debug-%d' % (n + 1)})(
+                html.a({'href': '/view?id=%s' % image.id})(
+                    html.img({'src': '/images/mini/%s.jpg' % image.id, 'class': 'mini-image'}))))
+        return [row]
+
+#----------------------------------------------------------
+@cmap('page-render')
+class PageRenderBenchmark(Config):
+    """
+        Render a page of search results with its header, left nav and
+        asset tags built into the page tree every time, and then with
+        the fragment cache, broken down into building the tree,
+        serializing it and each fragment.
+    """
+
+    PAGE_SIZE = 12
+    RENDERS = 1000
+
+    def __init__(self):
+        self.parse_args()
+
+    def __call__(self):
+        rng = random.Random(self.seed)
+        tags = ['tag%d' % n for n in range(40)]
+        pages = [[BenchImage('%032x' % rng.getrandbits(128), rng.sample(tags, 3))
+                  for _ in range(PageRenderBenchmark.PAGE_SIZE)] for _ in range(20)]
+        auth = BenchAuth(User('jenna', rights = [UserRight.USER, UserRight.UPLOAD]))
+        global_assets = ServerModule().global_assets()
+
+        print('==> %d renders of %d different result pages, %d images each.' % (
+            PageRenderBenchmark.RENDERS, len(pages), PageRenderBenchmark.PAGE_SIZE))
+        print('%-24s %10s %10s %10s %10s %10s %10s' % (
+            'fragments', 'total ms', 'build ms', 'serial ms', 'Header ms', 'LeftNav ms', 'Assets ms'))
+        for label, fragment_cache in (('built every time', UncachedFragments()),
+                                      ('cached', FragmentCache(1024, 8 * 1024 * 1024))):
+            for n in range(PageRenderBenchmark.RENDERS):
+                page = BenchPage(pages[n % len(pages)])
+                page.header = Header(auth)
+                page.nav = LeftNav(auth)
+                page.global_assets = global_assets
+                page.fragment_cache = fragment_cache
+                fragment_cache.render_page(page)
+
+            stats = fragment_cache.stats()['pages']['BenchPage']
+            fragments = stats['fragments']
+            print('%-24s %10.3f %10.3f %10.3f %10.3f %10.3f %10.3f' % (
+                label, stats['total']['avg_ms'], stats['build']['avg_ms'], stats['serialize']['avg_ms'],
+                fragments['Header']['avg_ms'], fragments['LeftNav']['avg_ms'], fragments['AssetList']['avg_ms']))
+
+#----------------------------------------------------------
+@cmap('query-plans')
+class QueryPlanBenchmark(Config):
+    """
+        Compare the query plans and timings of the hot queries on the
+        original schema and after every migration has been applied.
+    """
+
+    SEARCHES = [
+        ('tag search', 'public user:jenna -cat', None),
+        ('tag search, next page', 'public user:jenna -cat',
+         Cursor(2, Cursor.AFTER, '2016-01-01 00:00:00', '')),
+        ('prefix search', 'public date:*-2016', None),
+        ('boolean search', '(date:2016 or date:2017) user:jenna -(cat or dog)', None),
+    ]
+
+    QUERIES = [
+        ('tags by image', 'select id, tag from image_tags where id in (select id from images limit 12)', []),
+        ('images by tag', 'select id from image_tags where tag = ?', ['flag:processing']),
+        ('capture date range', 'select id from images where create_ts >= ? and create_ts < ?',
+         ['2016-01-01', '2016-02-01']),
+    ]
+
+    def __init__(self):
+        self.parse_args()
+
+    def __call__(self):
+        library = SyntheticLibrary(self.image_count, self.seed, schema_version = 1)
+        try:
+            self.report(library, 1)
+            migrate(library.db)
+            self.report(library, LATEST_VERSION)
+        finally:
+            library.close()
+
+    def get_queries(self, library):
+        c = library.db.cursor()
+        queries = []
+        for label, text, cursor in QueryPlanBenchmark.SEARCHES:
+            query = parse_query(text)
+            try:
+                counts = tag_query_compiler.get_counts(c, query)
+            except sqlite3.OperationalError:
+                # There are no tag statistics before migration 7.
+                counts = {}
+            if cursor is None:
+                sql, params = tag_query_compiler.compile_select(query, counts)
+            else:
+                sql, params = tag_query_compiler.compile_keyset_select(query, counts, cursor.direction)
+            queries.append((label, sql, params + tag_query_compiler.page_params(12, 0, cursor)))
+        return queries + QueryPlanBenchmark.QUERIES
+
+    def report(self, library, version):
+        print('==> Schema version %d, %d images, best of %d runs.' % (
+            version, self.image_count, self.repeat))
+        for label, query, params in self.get_queries(library):
+            elapsed, _ = time_call(lambda: library.db.execute(query, params).fetchall(), self.repeat)
+            print('%-40s %10.2f ms' % (label, elapsed * 1000))
+            for row in library.db.execute('explain query plan ' + query, params):
+                print('    %s' % row[-1])
+        print()
+
+#----------------------------------------------------------
+def thumbnail_sample(image_filename, mini_filename, reduced):
+    """
+        Make one thumbnail in a fresh process, returning the wall time
+        and the peak RSS (in KiB) added by the decode.
+    """
+    from jennabox.domain import Image
+    from jennabox.ingest import DEFAULT_RESOURCE_LIMITS, apply_resource_limits, ingest_image
+
+    if reduced:
+        apply_resource_limits(DEFAULT_RESOURCE_LIMITS)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    ingest_image(image_filename, mini_filename,
+                 decode_size = Image.THUMB_DECODE_SIZE if reduced else None)
+    elapsed = time.perf_counter() - start
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+
+#----------------------------------------------------------
+@cmap('thumbnail')
+class ThumbnailBenchmark(Config):
+    def __init__(self):
+        self.parse_args()
+
+    def get_arg_parser(self):
+        parent = super().get_arg_parser()
+        parser = argparse.ArgumentParser(parents = [parent], prog = 'bench.py thumbnail')
+        parser.add_argument('images', metavar='IMAGE', nargs='+')
+        return parser
+
+    def __call__(self):
+        ctx = multiprocessing.get_context('spawn')
+        out_dir = tempfile.mkdtemp(prefix = 'jennabox-bench-')
+        try:
+            print('%-40s %-8s %10s %12s' % ('image', 'decode', 'wall ms', 'peak rss MiB'))
+            for image_filename in self.images:
+                mini_filename = os.path.join(out_dir, os.path.basename(image_filename))
+                for reduced in (False, True):
+                    samples = []
+                    for _ in range(self.repeat):
+                        with ctx.Pool(1) as pool:
+                            samples.append(pool.apply(thumbnail_sample, (image_filename, mini_filename, reduced)))
+                    print('%-40s %-8s %10.1f %12.1f' % (
+                        os.path.basename(image_filename)[:40],
+                        'reduced' if reduced else 'full',
+                        1000 * min(elapsed for elapsed, rss in samples),
+                        max(rss for elapsed, rss in samples) / 1024.0))
+        finally:
+            shutil.rmtree(out_dir)
+
+#----------------------------------------------------------
+def main():
+    try:
+        config = Config().parse_args()
+        if config.command is None:
+            raise Exception('Command is required, known commands: %s' % ', '.join(cmap.commands()))
+
+        if config.command not in cmap:
+            raise Exception('Unknown command, known commands: %s' % ', '.join(cmap.commands()))
+
+        cmap[config.command]()()
+
+    except Exception as e:
+        print(str(e))
+        sys.exit(1)
+
+#----------------------------------------------------------
+if __name__ == '__main__':
+    main()
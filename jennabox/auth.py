@@ -6,9 +6,17 @@
 # Date: Tuesday, August 23rd 2016
 #--------------------------------------------------------------------
 
+import base64
 import cherrypy
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import os
 import random
 import string
+import threading
+import time
 
 from passlib.hash import bcrypt
 from getpass import getpass
@@ -18,6 +26,7 @@ from xenum import *
 
 from .framework import ThreadLocalStorage, Cookies
 from .domain import *
+from .metrics import Timing
 
 #--------------------------------------------------------------------
 TOKEN_COOKIE = 'jennabook_login'
@@ -38,6 +47,154 @@ def input_password():
         else:
             print('Passwords do not match.  Please try again.')
 
+#--------------------------------------------------------------------
+def load_secret(filename, length = 32):
+    """
+        Read a secret key from a file, creating it with a new random key
+        readable only by its owner if it doesn't exist yet.
+    """
+    try:
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(filename, 'rb') as infile:
+            return infile.read()
+    with os.fdopen(fd, 'wb') as outfile:
+        secret = os.urandom(length)
+        outfile.write(secret)
+    return secret
+
+#--------------------------------------------------------------------
+class PasswordHasherBusy(Exception):
+    pass
+
+#--------------------------------------------------------------------
+class PasswordHasher:
+    """
+        Hashes and verifies passwords with bcrypt on a small dedicated
+        thread pool.  At most max_workers hashes run at once and at
+        most max_queue more wait for a worker, so a burst of logins
+        can only hold that many request threads.  Beyond that, calls
+        fail at once with PasswordHasherBusy.
+    """
+
+    def __init__(self, hash_rounds, max_workers, max_queue):
+        self.handler = bcrypt.using(rounds = hash_rounds)
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix = 'jennabox-bcrypt')
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.wait_timing = Timing()
+        self.verify_timing = Timing()
+        self.hash_timing = Timing()
+
+    def verify(self, password, passhash):
+        return self._run(self.verify_timing, self.handler.verify, password, passhash)
+
+    def hash(self, password):
+        return self._run(self.hash_timing, self.handler.hash, password)
+
+    def upgrade(self, password, passhash):
+        """
+            Get a new hash for a password which was just verified, if
+            its hash was made with other settings such as fewer rounds.
+            Returns None if the hash is current, or if the hasher is too
+            busy, in which case the next login will try again.
+        """
+        if not self.handler.needs_update(passhash):
+            return None
+        try:
+            passhash = self.hash(password)
+        except PasswordHasherBusy:
+            return None
+        with self.lock:
+            self.rehashed += 1
+        return passhash
+
+    def shutdown(self):
+        self.executor.shutdown(wait = True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers':      self.max_workers,
+                'max_queue':    self.max_queue,
+                'queue_depth':  self.pending,
+                'rejected':     self.rejected,
+                'rehashed':     self.rehashed,
+                'queue_wait':   self.wait_timing.stats(),
+                'verify':       self.verify_timing.stats(),
+                'hash':         self.hash_timing.stats()
+            }
+
+    def _run(self, timing, fn, *args):
+        with self.lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise PasswordHasherBusy()
+            self.pending += 1
+
+        submitted = time.time()
+        def run():
+            started = time.time()
+            self.wait_timing.record(started - submitted)
+            try:
+                return fn(*args)
+            finally:
+                timing.record(time.time() - started)
+
+        try:
+            return self.executor.submit(run).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+#--------------------------------------------------------------------
+class LoginSigner:
+    """
+        Issues and verifies login tokens which carry the username,
+        expiry time and the user's login generation, signed with
+        HMAC-SHA256.  Any server process sharing the secret can verify
+        a token without looking up the login, so requests need not be
+        routed to the process which logged the user in.
+    """
+
+    def __init__(self, secret):
+        self.secret = secret
+
+    def sign(self, login, generation):
+        payload = self._encode(json.dumps(
+            [login.username, int(login.expiry_dt.timestamp()), generation],
+            separators = (',', ':')).encode('utf-8'))
+        return '%s.%s' % (payload, self._signature(payload))
+
+    def verify(self, token):
+        """
+            Get the Login a token was issued for, or None if the token
+            is malformed or its signature doesn't match.  Expiry and
+            generation are left to the caller.
+        """
+        payload, _, signature = token.partition('.')
+        try:
+            if not hmac.compare_digest(signature.encode('utf-8'), self._signature(payload).encode('ascii')):
+                return None
+            username, expiry, generation = json.loads(self._decode(payload).decode('utf-8'))
+            return Login(username, datetime.fromtimestamp(expiry), token, generation)
+        except ValueError:
+            return None
+
+    def _signature(self, payload):
+        return self._encode(hmac.new(self.secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+    def _encode(self, data):
+        return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+    def _decode(self, text):
+        return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
 #--------------------------------------------------------------------
 class AuthModule:
     @provide
@@ -52,49 +209,108 @@ class AuthModule:
     @provide
     @singleton
     def hash_rounds(self):
+        # Existing hashes with other rounds are upgraded on login.
         return 12 # 2**12
 
+    @provide
+    @singleton
+    def password_hash_workers(self):
+        return 2
+
+    @provide
+    @singleton
+    def password_hash_max_queue(self):
+        # Logins beyond the workers and this many waiting get a 503.
+        return 4
+
+    @provide
+    @singleton
+    def password_hasher(self, metrics, hash_rounds, password_hash_workers, password_hash_max_queue):
+        password_hasher = PasswordHasher(hash_rounds, password_hash_workers, password_hash_max_queue)
+        metrics.register('password_hasher', password_hasher.stats)
+        cherrypy.engine.subscribe('exit', password_hasher.shutdown)
+        return password_hasher
+
+    @provide
+    @singleton
+    def signed_logins_enabled(self):
+        # Issue signed login tokens rather than keeping logins in the
+        # login dao, so that several server processes can share the
+        # load.  Revocation is seen by other processes once their user
+        # cache entry expires, see user_cache_ttl.
+        return False
+
+    @provide
+    @singleton
+    def login_secret_file(self):
+        # Every server process must share this file.
+        return os.path.abspath(os.path.expanduser('~/.jennabox-login-secret'))
+
+    @provide
+    @singleton
+    def login_signer(self, signed_logins_enabled, login_secret_file):
+        if not signed_logins_enabled:
+            return None
+        return LoginSigner(load_secret(login_secret_file))
+
 #--------------------------------------------------------------------
 class AuthProvider:
-    def __init__(self, log, dao_factory, expiry_timedelta, hash_rounds):
+    def __init__(self, log, dao_factory, expiry_timedelta, password_hasher, login_signer):
         self.log = log
         self.dao_factory = dao_factory
         self.expiry_timedelta = expiry_timedelta
-        self.hash_rounds = hash_rounds
+        self.password_hasher = password_hasher
+        self.login_signer = login_signer
 
     def login(self, username, password):
         user_dao = self.dao_factory.get_user_dao()
-        login_dao = self.dao_factory.get_login_dao()
 
         user = user_dao.get(username)
         if user is None:
             raise LoginFailure()
-        if bcrypt.verify(password, user.passhash):
-            login = Login(user.username, datetime.now() + self.expiry_timedelta)
-            login_dao.put(login)
-            self._write_cookie_token(login.token)
+        if self._verify_password(password, user.passhash):
+            passhash = self.password_hasher.upgrade(password, user.passhash)
+            if passhash is not None:
+                user.passhash = passhash
+                user_dao.put(user)
+                self.log.info('Upgraded the password hash of user %s.' % user.username)
+            self._issue_login(user)
             raise cherrypy.HTTPRedirect('/')
         else:
             raise LoginFailure()
 
     def logout(self, login):
-        login_dao = self.dao_factory.get_login_dao()
-        login_dao.drop(login.token)
+        if self.login_signer is not None:
+            # Signed tokens can't be forgotten, only revoked.
+            user_dao = self.dao_factory.get_user_dao()
+            user = user_dao.get(login.username)
+            if user is not None:
+                user_dao.bump_login_generation(user)
+        else:
+            login_dao = self.dao_factory.get_login_dao()
+            login_dao.drop(login.token)
         ThreadLocalStorage().remove(CURRENT_USER)
         raise cherrypy.HTTPRedirect('/')
 
     def change_password(self, user, old_password, new_password):
-        if bcrypt.verify(old_password, user.passhash):
+        if self._verify_password(old_password, user.passhash):
             user.remove_attribute(UserAttribute.PASSWORD_RESET_REQUIRED)
             user.passhash = self.encrypt_password(new_password)
             user_dao = self.dao_factory.get_user_dao()
             user_dao.put(user)
+            if self.login_signer is not None:
+                # Revoke any other signed logins, but keep this one.
+                user_dao.bump_login_generation(user)
+                self._issue_login(user)
             raise cherrypy.HTTPRedirect('/')
         else:
             raise LoginFailure()
 
     def encrypt_password(self, password):
-        return bcrypt.encrypt(password, rounds = self.hash_rounds)
+        try:
+            return self.password_hasher.hash(password)
+        except PasswordHasherBusy:
+            raise self._busy()
 
     def get_login(self, token = None):
         if token is None:
@@ -103,6 +319,15 @@ class AuthProvider:
         if token is None:
             return None
 
+        if self.login_signer is not None:
+            login = self.login_signer.verify(token)
+            if login is None or not login.is_valid():
+                return None
+            user = self.dao_factory.get_user_dao().get(login.username)
+            if user is None or user.login_generation != login.generation:
+                return None
+            return login
+
         login_dao = self.dao_factory.get_login_dao()
         login = login_dao.get(token)
         if login is not None and login.is_valid():
@@ -126,6 +351,25 @@ class AuthProvider:
 
         return user
 
+    def _verify_password(self, password, passhash):
+        try:
+            return self.password_hasher.verify(password, passhash)
+        except PasswordHasherBusy:
+            raise self._busy()
+
+    def _busy(self):
+        cherrypy.response.headers['Retry-After'] = '5'
+        return cherrypy.HTTPError(503, 'Too many logins at once, please try again in a few seconds.')
+
+    def _issue_login(self, user):
+        login = Login(user.username, datetime.now() + self.expiry_timedelta)
+        if self.login_signer is not None:
+            login.token = self.login_signer.sign(login, user.login_generation)
+        else:
+            self.dao_factory.get_login_dao().put(login)
+        self._write_cookie_token(login.token)
+        return login
+
     def _read_cookie_token(self):
         return Cookies().get(TOKEN_COOKIE)
 
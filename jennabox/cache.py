@@ -0,0 +1,191 @@
+#--------------------------------------------------------------------
+# JennaBox: A lightweight privacy-focused image tagging and
+#           sharing website.
+#
+# Author: Lain Supe (lainproliant)
+# Date: Tuesday, August 23rd 2016
+#--------------------------------------------------------------------
+
+import collections
+import threading
+import time
+
+#--------------------------------------------------------------------
+class LRUCache:
+    """
+        A thread-safe least-recently-used cache bounded by both entry
+        count and an estimate of the size of its values in bytes.  If a
+        ttl in seconds is given, entries older than that are misses.
+    """
+
+    def __init__(self, max_entries, max_bytes = None, ttl = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key, default = None):
+        with self.lock:
+            if key in self.entries:
+                value, size, expiry = self.entries[key]
+                if expiry is not None and time.monotonic() >= expiry:
+                    self._remove(key)
+                    self.expired += 1
+                    self.misses += 1
+                    return default
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            else:
+                self.misses += 1
+                return default
+
+    def put(self, key, value, size = 0):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            expiry = time.monotonic() + self.ttl if self.ttl is not None else None
+            self.entries[key] = (value, size, expiry)
+            self.bytes += size
+            while (len(self.entries) > self.max_entries or
+                   (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries':      len(self.entries),
+                'bytes':        self.bytes,
+                'max_entries':  self.max_entries,
+                'max_bytes':    self.max_bytes,
+                'ttl':          self.ttl,
+                'hits':         self.hits,
+                'misses':       self.misses,
+                'evictions':    self.evictions,
+                'expired':      self.expired,
+                'hit_rate':     float(self.hits) / lookups if lookups else 0.0
+            }
+
+    def _remove(self, key):
+        value, size, expiry = self.entries.pop(key)
+        self.bytes -= size
+
+#--------------------------------------------------------------------
+class SearchCache:
+    """
+        Caches search pages and counts.  Every write to the image
+        library bumps a generation counter, and entries stamped with
+        an older generation are treated as misses.  Writes made by
+        other processes can't bump the counter, so entries also expire
+        after ttl seconds.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl = None):
+        self.cache = LRUCache(max_entries, max_bytes, ttl)
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.stale = 0
+
+    def key(self, query, limit, offset, cursor, sort):
+        return (str(query), sort, limit, offset if cursor is None else None,
+                cursor.encode() if cursor is not None else None)
+
+    def get(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+
+        generation, images, count = entry
+        if generation != self.generation:
+            self.cache.remove(key)
+            with self.lock:
+                self.stale += 1
+            return None
+        return list(images), count
+
+    def put(self, key, generation, images, count):
+        """
+            Cache a result which was computed while the library was at
+            the given generation.  Results computed before a concurrent
+            write completed are dropped rather than cached.
+        """
+        if generation != self.generation:
+            return
+        self.cache.put(key, (generation, list(images), count), self.estimate_size(images))
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+
+    def stats(self):
+        stats = self.cache.stats()
+        # Entries from an old generation are found by the LRU but are
+        # misses as far as callers are concerned.
+        stats['hits'] -= self.stale
+        stats['misses'] += self.stale
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        stats['generation'] = self.generation
+        stats['stale'] = self.stale
+        return stats
+
+    def estimate_size(self, images):
+        size = 128
+        for image in images:
+            size += 256 + len(image.id) + len(image.summary or '')
+            size += sum(64 + len(tag) for tag in image.tags)
+        return size
+
+#--------------------------------------------------------------------
+class UserCache:
+    """
+        Caches users by username, so that resolving the logged in user
+        doesn't query the database on every request.  Saving a user
+        bumps a generation counter, so that a user read before the save
+        completed is never cached.  Entries expire after a short ttl so
+        that changes made by other processes, such as admin.py, are
+        picked up.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.cache = LRUCache(max_entries, ttl = ttl)
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    def get(self, username):
+        return self.cache.get(username)
+
+    def put(self, username, generation, user):
+        with self.lock:
+            if generation == self.generation:
+                self.cache.put(username, user)
+
+    def invalidate(self, username):
+        with self.lock:
+            self.generation += 1
+            self.cache.remove(username)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['generation'] = self.generation
+        return stats
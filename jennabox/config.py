@@ -14,6 +14,7 @@ import os
 from xeno import *
 from .auth import random_password
 from .domain import *
+from .metrics import Metrics
 
 #--------------------------------------------------------------------
 class ServerModule:
@@ -68,6 +69,11 @@ class ServerModule:
             }
         }
 
+    @provide
+    @singleton
+    def metrics(self):
+        return Metrics()
+
     @provide
     @singleton
     def log(self):
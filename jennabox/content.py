@@ -10,12 +10,13 @@ import json
 import cherrypy
 
 from .domain import *
-from .framework import Renderer, AssetList
+from .framework import Renderer, AssetList, FragmentCache
 from .markup import markup
+from .query import AndTerm, Cursor, QuerySyntaxError, SortOrder, TagTerm, make_term, parse_query, tag_query_compiler
 
 from urllib.parse import urlencode
 from indenti import html
-from xeno import inject, provide
+from xeno import inject, provide, singleton
 
 #--------------------------------------------------------------------
 class Page(Renderer):
@@ -23,14 +24,14 @@ class Page(Renderer):
         return html.html({'ng-app': 'JennaBox'}).doctype('html')(
             html.head(
                 html.title(self.title())),
-                AssetList().assets(self.assets()).render(),
+                self.fragment_cache.render(AssetList().assets(self.assets())),
                 self.body())
 
     def body(self):
         content = self.content()
-        nav = self.nav.render()
+        nav = self.fragment_cache.render(self.nav)
         return [
-            self.header.render(),
+            self.fragment_cache.render(self.header),
             html.div({'class': 'container-fluid'})(
                 html.div({'class': 'row'})(
                     html.div({'class': 'col-md-2'})(nav),
@@ -47,10 +48,11 @@ class Page(Renderer):
         raise NotImplementedError()
 
     @inject
-    def inject_deps(self, injector, header, nav, global_assets):
+    def inject_deps(self, injector, header, nav, global_assets, fragment_cache):
         self.global_assets = global_assets
         self.header = header
         self.nav = nav
+        self.fragment_cache = fragment_cache
 
 #--------------------------------------------------------------------
 class Header(Renderer):
@@ -59,6 +61,12 @@ class Header(Renderer):
         self.auth = auth
         self.user = auth.get_user()
 
+    def actions(self):
+        return [action() for action in Action.values() if action().is_available(self.user)]
+
+    def cache_key(self):
+        return (self.user.is_guest(), self.user.username, tuple(action.href for action in self.actions()))
+
     def render(self):
         login_elements = []
 
@@ -86,14 +94,14 @@ class Header(Renderer):
                 html.div({'id': 'navbar', 'class': 'navbar-collapse collapse'})(
                     html.ul({'class': 'nav navbar-nav navbar-right'})(
                         login_elements,
-                        [html.li(html.a(href = action().href)(
-                            action().label,
-                            markup.icon(action().icon))) for action in Action.values() if action().is_available(self.user)]),
+                        [html.li(html.a(href = action.href)(
+                            action.label,
+                            markup.icon(action.icon))) for action in self.actions()]),
                     html.form({'class': 'navbar-form navbar-right', 'action': '/search', 'method': 'get'})(
-                        html.input({'type': 'text', 'name': 'query', 'class': 'form-control', 'placeholder': 'Search with tags'})))))
+                        html.input({'type': 'text', 'name': 'query', 'class': 'form-control', 'placeholder': 'Search with tags or "quoted text"'})))))
 
 #--------------------------------------------------------------------
-class LeftNav:
+class LeftNav(Renderer):
     def __init__(self, auth):
         self.auth = auth
         self.tags = []
@@ -112,6 +120,16 @@ class LeftNav:
         self.image = image
         self.set_tags_from_images([image])
 
+    def editable_image(self):
+        user = self.auth.get_user()
+        if self.image and user and self.image.can_edit(user):
+            return self.image
+        return None
+
+    def cache_key(self):
+        image = self.editable_image()
+        return (tuple(self.tags), image.id if image is not None else None)
+
     def render(self):
         container = html.div({'class': 'left-nav'})
 
@@ -125,13 +143,11 @@ class LeftNav:
                 'value':        json.dumps(self.tags)}))
 
         row = html.div({'class': 'row image-controls'})
-        user = self.auth.get_user()
-        if self.image and user:
-            user_tag = 'user:%s' % user.username
-            if self.image.can_edit(user):
-                row(markup.button('Edit', '/edit?' + urlencode({'id': self.image.id}),
-                    lefticon = 'pencil-square-o'))
-                container(row)
+        image = self.editable_image()
+        if image is not None:
+            row(markup.button('Edit', '/edit?' + urlencode({'id': image.id}),
+                lefticon = 'pencil-square-o'))
+            container(row)
 
         if self.tags:
             row = html.div({'class': 'row', 'ng-show': 'tags.length > 0'})
@@ -144,70 +160,160 @@ class LeftNav:
 
 #--------------------------------------------------------------------
 class ImageSearchPage(Page):
-    def __init__(self, query = '', page = 1):
+    # Number of page links shown on either side of the current page.
+    NAV_WINDOW = 3
+
+    def __init__(self, query = '', page = 1, cursor = None, sort = None):
         super().__init__()
-        self.tags = []
-        self.ntags = []
-        self.page = int(page)
+        self.page = max(int(page), 1)
+        self.cursor = None
         self.query = query
-
-        for tag in query.split():
-            if tag.startswith('-'):
-                self.ntags.append(tag[1:])
-            else:
-                self.tags.append(tag)
+        self.search = None
+        self.error = None
+
+        if cursor is not None:
+            try:
+                self.cursor = Cursor.decode(cursor)
+                self.page = max(self.cursor.page, 1)
+            except ValueError:
+                pass
+
+        try:
+            self.search = parse_query(query)
+        except QuerySyntaxError as e:
+            self.error = str(e)
+
+        # Text searches are shown best matches first unless asked otherwise.
+        self.default_sort = SortOrder.UPLOADED
+        if self.search is not None and tag_query_compiler.ranked_term(self.search, SortOrder.RELEVANCE) is not None:
+            self.default_sort = SortOrder.RELEVANCE
+        self.sort = sort if sort in SortOrder.COLUMNS else self.default_sort
 
     def content(self):
         results = []
         image_dao = self.dao_factory.get_image_dao()
 
+        if self.error is not None:
+            return [markup.error(self.error)]
+
         # Non logged in users must only see images with 'public'
+        search = self.search
         if not self.user.has_right(UserRight.USER):
-            self.tags.append('public')
-            self.ntags = list(filter(lambda x: x != 'public', self.ntags))
+            search = make_term(AndTerm, [TagTerm('public'), search])
 
-        images, count = image_dao.find(self.tags, self.ntags,
-                                       self.image_page_size, self.image_page_size * (self.page - 1))
+        images, count = image_dao.find(search, self.image_page_size,
+                                       self.image_page_size * (self.page - 1), self.cursor, self.sort)
 
         self.nav.set_tags_from_images(images)
-
-        row = html.div({'class': 'row'})
-        ul = html.ul({'class': 'pagination'})
-        row(ul)
-
-        page_count = 1 + int((count - 1) / (self.image_page_size or 1))
-        if page_count > 1:
-            for x in range(0, page_count):
-                page_num = x + 1
-                button = markup.button('%d' % page_num, '/search?' + urlencode({
-                        'query':    self.query,
-                        'page':     page_num}))
-                ul(button)
-
-                if self.page == page_num:
-                    button({'class': 'btn-current'})
-                else:
-                    button({'class': 'btn-inverse'})
-
-        results.append(row)
+        results.append(self.sort_buttons())
+        results.append(self.pagination(images, count))
 
         row = html.div({'class': 'row'})
         debug_n = 0
         for image in images:
             debug_n += 1
+            if image.has_thumbnail():
+                mini_src = '/images/mini/' + image.get_filename()
+            else:
+                mini_src = '/static/images/placeholder.png'
+            mini_attrs = {'src': mini_src, 'class': 'mini-image'}
+            if self.animated_previews_enabled and Image.ANIMATED_TAG in image.tags:
+                mini_attrs['data-preview'] = '/images/preview/%s.gif' % image.get_file_id()
             row(html.div({'class': 'col-md-3 image-result debug-%d' % debug_n})(
                 html.a({'href': '/view?id=%s' % image.id})(
-                    html.img({'src': '/images/mini/' + image.get_filename(), 'class': 'mini-image'}))))
+                    html.img(mini_attrs))))
         results.append(row)
 
         return results
 
+    def sort_buttons(self):
+        row = html.div({'class': 'row'})
+        sorts = [('Newest uploads', SortOrder.UPLOADED), ('Newest photos', SortOrder.TAKEN)]
+        if self.default_sort == SortOrder.RELEVANCE:
+            sorts.insert(0, ('Best matches', SortOrder.RELEVANCE))
+        for label, sort in sorts:
+            params = {'query': self.query}
+            if sort != self.default_sort:
+                params['sort'] = sort
+            button = markup.button(label, '/search?' + urlencode(params))
+            button({'class': 'btn-current' if sort == self.sort else 'btn-inverse'})
+            row(button)
+        return row
+
+    def pagination(self, images, count):
+        row = html.div({'class': 'row'})
+        ul = html.ul({'class': 'pagination'})
+        row(ul)
+
+        page_count = 1 + int((count - 1) / (self.image_page_size or 1))
+        if page_count <= 1:
+            return row
+
+        first = max(1, self.page - ImageSearchPage.NAV_WINDOW)
+        last = min(page_count, self.page + ImageSearchPage.NAV_WINDOW)
+
+        if self.page > 1:
+            ul(self.page_button('\u00ab', 1, page_count, images))
+            ul(self.page_button('\u2039', self.page - 1, page_count, images))
+
+        for page_num in range(first, last + 1):
+            ul(self.page_button('%d' % page_num, page_num, page_count, images))
+
+        if self.page < page_count:
+            ul(self.page_button('\u203a', self.page + 1, page_count, images))
+            ul(self.page_button('\u00bb', page_count, page_count, images))
+
+        return row
+
+    def page_button(self, label, page_num, page_count, images):
+        params = {'query': self.query}
+        if self.sort != self.default_sort:
+            params['sort'] = self.sort
+        cursor = self.page_cursor(page_num, page_count, images)
+
+        if cursor is not None:
+            params['cursor'] = cursor.encode()
+        elif page_num > 1:
+            params['page'] = page_num
+
+        button = markup.button(label, '/search?' + urlencode(params))
+        if self.page == page_num:
+            button({'class': 'btn-current'})
+        else:
+            button({'class': 'btn-inverse'})
+        return button
+
+    def page_cursor(self, page_num, page_count, images):
+        """
+            Build a cursor which reaches the given page from the images
+            on the current page, so that navigating never needs a deep
+            offset scan.  The first page needs no cursor at all, and
+            pages of results ranked by relevance are found by offset.
+        """
+        size = self.image_page_size
+
+        if page_num == 1 or self.sort == SortOrder.RELEVANCE:
+            return None
+        elif page_num == self.page:
+            return self.cursor
+        elif page_num == page_count:
+            return Cursor(page_num, Cursor.LAST)
+        elif not images:
+            return None
+        elif page_num > self.page:
+            return Cursor(page_num, Cursor.AFTER, SortOrder.value(self.sort, images[-1]), images[-1].id,
+                          skip = size * (page_num - self.page - 1))
+        else:
+            return Cursor(page_num, Cursor.BEFORE, SortOrder.value(self.sort, images[0]), images[0].id,
+                          skip = size * (self.page - page_num - 1))
+
     @inject
-    def inject_deps(self, auth, dao_factory, image_page_size):
+    def inject_deps(self, auth, dao_factory, image_page_size, animated_previews_enabled):
         self.user = auth.get_user()
         self.auth = auth
         self.dao_factory = dao_factory
         self.image_page_size = image_page_size
+        self.animated_previews_enabled = animated_previews_enabled
 
 #--------------------------------------------------------------------
 class ImageViewPage(Page):
@@ -223,8 +329,14 @@ class ImageViewPage(Page):
 
         self.nav.set_image(image)
 
+        view_src = '/images/' + image.get_filename()
+        if (Image.ANIMATED_TAG in image.tags and
+                image_dao.get_metadata(image).get(Image.WEBP_KEY)):
+            # A smaller lossless WebP of the animation was kept.
+            view_src = '/images/anim/%s.webp' % image.get_file_id()
+
         return [html.a({'href': '/images/' + image.get_filename()})(
-                    html.img({'src': '/images/' + image.get_filename(), 'class': 'image-view'})),
+                    html.img({'src': view_src, 'class': 'image-view'})),
                 html.div({'id': 'summary_display', 'data-markdown': image.summary})]
 
     @inject
@@ -359,3 +471,20 @@ class ContentModule:
     async def header(self, injector):
         return await injector.create_async(Header)
 
+    @provide
+    @singleton
+    def fragment_cache_max_entries(self):
+        return 1024
+
+    @provide
+    @singleton
+    def fragment_cache_max_bytes(self):
+        return 8 * 1024 * 1024
+
+    @provide
+    @singleton
+    def fragment_cache(self, metrics, fragment_cache_max_entries, fragment_cache_max_bytes):
+        fragment_cache = FragmentCache(fragment_cache_max_entries, fragment_cache_max_bytes)
+        metrics.register('render', fragment_cache.stats)
+        return fragment_cache
+
@@ -8,15 +8,26 @@
 
 import cherrypy
 import collections
+import contextlib
+import copy
+import hashlib
+import heapq
 import os
 import sqlite3
-import wand.image
+import threading
+import time
 
 from datetime import datetime
 from xeno import *
 
 from .dao import *
+from .cache import SearchCache, UserCache
+from .db import ConnectionManager
 from .domain import *
+from .index import TagIndex
+from .ingest import DEFAULT_RESOURCE_LIMITS, IngestPool, apply_resource_limits, ingest_image
+from .migrations import LATEST_VERSION, MigrationError, current_version, migrate
+from .query import Cursor, SortOrder, last_page_size, tag_query_compiler
 
 #--------------------------------------------------------------------
 class DaoModule:
@@ -27,34 +38,187 @@ class DaoModule:
 
     @provide
     @singleton
-    def ddl_file(self):
-        return 'jennabox-ddl.sql'
+    def schema_auto_migrate(self):
+        return False
 
     @provide
-    def db_conn(self, log, db_file, ddl_file):
-        if not hasattr(cherrypy.thread_data, 'db_conn'):
-            if not os.path.exists(db_file):
-                log.warn('sqlite database does not exist.  Creating...')
-                with sqlite3.connect(db_file) as db:
-                    with open(ddl_file, 'rt') as infile:
-                        db.executescript(infile.read())
-                log.warn('sqlite database created successfully.')
-            cherrypy.thread_data.db_conn = sqlite3.connect(db_file)
-        return cherrypy.thread_data.db_conn
+    @singleton
+    def db_max_readers(self):
+        return 8
+
+    @provide
+    @singleton
+    def database(self, log, metrics, db_file, schema_auto_migrate, db_max_readers):
+        if not os.path.exists(db_file):
+            log.warn('sqlite database does not exist.  Creating...')
+            with contextlib.closing(sqlite3.connect(db_file)) as db:
+                migrate(db, log = log)
+            log.warn('sqlite database created successfully.')
+        else:
+            with contextlib.closing(sqlite3.connect(db_file)) as db:
+                version = current_version(db)
+                if version < LATEST_VERSION:
+                    if not schema_auto_migrate:
+                        raise MigrationError('The database is at schema version %d of %d.  Run "admin.py migrate" to upgrade it.' % (
+                            version, LATEST_VERSION))
+                    migrate(db, log = log)
+                elif version > LATEST_VERSION:
+                    raise MigrationError('The database schema version %d is newer than this version of JennaBox supports (%d).' % (
+                        version, LATEST_VERSION))
+        database = ConnectionManager(log, db_file, db_max_readers)
+        metrics.register('database', database.stats)
+        cherrypy.engine.subscribe('exit', database.close)
+        return database
+
+    @provide
+    @singleton
+    def tag_index_enabled(self):
+        return False
+
+    @provide
+    @singleton
+    def tag_index(self, log, database, tag_index_enabled):
+        if not tag_index_enabled:
+            return None
+
+        tag_index = TagIndex()
+        start = time.perf_counter()
+        with database.read() as db:
+            tag_index.rebuild(db)
+        log.info('Tag index built for %d images in %.2fs.' % (
+            len(tag_index.ordinals), time.perf_counter() - start))
+        return tag_index
+
+    @provide
+    @singleton
+    def search_cache_max_entries(self):
+        return 1024
+
+    @provide
+    @singleton
+    def search_cache_max_bytes(self):
+        return 32 * 1024 * 1024
+
+    @provide
+    @singleton
+    def search_cache_ttl(self):
+        # Seconds before a cached search is run again, so that writes
+        # made by other processes, such as admin.py, are picked up.
+        return 30
+
+    @provide
+    @singleton
+    def search_cache(self, metrics, search_cache_max_entries, search_cache_max_bytes, search_cache_ttl):
+        search_cache = SearchCache(search_cache_max_entries, search_cache_max_bytes, search_cache_ttl)
+        metrics.register('search_cache', search_cache.stats)
+        return search_cache
+
+    @provide
+    @singleton
+    def user_cache_max_entries(self):
+        return 256
+
+    @provide
+    @singleton
+    def user_cache_ttl(self):
+        # Seconds before a cached user is read from the database again.
+        return 30
+
+    @provide
+    @singleton
+    def user_cache(self, metrics, user_cache_max_entries, user_cache_ttl):
+        user_cache = UserCache(user_cache_max_entries, user_cache_ttl)
+        metrics.register('user_cache', user_cache.stats)
+        return user_cache
+
+    @provide
+    @singleton
+    def ingest_workers(self):
+        return max(1, (os.cpu_count() or 2) // 2)
+
+    @provide
+    @singleton
+    def ingest_max_queue(self):
+        return 64
+
+    @provide
+    @singleton
+    def ingest_job_timeout(self):
+        # Seconds before a stuck ingest job is given up on and its
+        # image flagged as failed.
+        return 300
+
+    @provide
+    @singleton
+    def imagemagick_limits(self):
+        return dict(DEFAULT_RESOURCE_LIMITS)
+
+    @provide
+    @singleton
+    def date_tags_enabled(self):
+        # New images get date:YYYY and date:MM-YYYY tags as well as
+        # their capture date.  Searches can use after: and before:
+        # instead, which keeps these tags out of image_tags.
+        return True
+
+    @provide
+    @singleton
+    def animated_previews_enabled(self):
+        return True
+
+    @provide
+    @singleton
+    def animated_webp_enabled(self):
+        return False
+
+    @provide
+    @singleton
+    def ingest_pool(self, log, metrics, dao_factory, ingest_workers, ingest_max_queue,
+                    ingest_job_timeout, imagemagick_limits):
+        # Inline ingest and metadata refreshes decode in this process.
+        apply_resource_limits(imagemagick_limits)
+        ingest_pool = IngestPool(log, dao_factory, ingest_workers, ingest_max_queue,
+                                 ingest_job_timeout, imagemagick_limits)
+        metrics.register('ingest', ingest_pool.stats)
+        return ingest_pool
+
+    @provide
+    @singleton
+    def max_logins(self):
+        return 100000
+
+    @provide
+    @singleton
+    def login_sweep_interval(self):
+        # Seconds between sweeps for expired logins.
+        return 60
+
+    @provide
+    @singleton
+    def login_dao(self, log, metrics, database, max_logins, login_sweep_interval):
+        login_dao = SqliteLoginDao(log, database, max_logins, login_sweep_interval)
+        metrics.register('logins', login_dao.stats)
+        cherrypy.engine.subscribe('exit', login_dao.close)
+        return login_dao
 
     @provide
     @singleton
-    def dao_factory(self, injector):
-        return SqliteDaoFactory(injector)
+    def dao_factory(self, injector, login_dao):
+        return SqliteDaoFactory(injector, login_dao)
 
 #--------------------------------------------------------------------
 class SqliteDaoFactory:
-    def __init__(self, injector):
+    def __init__(self, injector, login_dao):
         self.injector = injector
-        self.login_dao = InMemoryLoginDao()
+        self.login_dao = login_dao
+        self.user_dao = None
 
     def get_user_dao(self):
-        return self.injector.create(SqliteUserDao)
+        # Users are resolved on every request and the dao keeps no state
+        # of its own, so one is shared rather than injected each time.
+        if self.user_dao is None:
+            self.user_dao = self.injector.create(SqliteUserDao)
+        return self.user_dao
 
     def get_image_dao(self):
         return self.injector.create(SqliteImageDao)
@@ -63,32 +227,153 @@ class SqliteDaoFactory:
         return self.login_dao
 
 #--------------------------------------------------------------------
-class InMemoryLoginDao:
-    def __init__(self):
-        self.cache = {}
+class SqliteLoginDao:
+    """
+        Keeps logins in memory, written through to the logins table so
+        that they survive a restart.  A min-heap of expiry times lets
+        expired logins be cleared without looking at the rest, which a
+        sweeper thread does every sweep_interval seconds.  Beyond
+        max_logins, the logins closest to expiring are dropped early.
+    """
+
+    TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+    # Rough size of a login with its dict and heap entries, in bytes.
+    LOGIN_SIZE = 272
+
+    def __init__(self, log, database, max_logins, sweep_interval):
+        self.log = log
+        self.database = database
+        self.max_logins = max_logins
+        self.sweep_interval = sweep_interval
+        self.lock = threading.Lock()
+        self.logins = {}
+        self.bytes = 0
+        # (expiry_dt, token) pairs.  Pairs for logins which have since
+        # been dropped or replaced are skipped when they reach the top.
+        self.expiry_heap = []
+        self.expired = 0
+        self.evicted = 0
+        self.sweeps = 0
+        self.loaded = self._load()
+
+        self.stopped = threading.Event()
+        self.sweeper = threading.Thread(target = self._sweep_loop,
+                                        name = 'jennabox-login-sweeper', daemon = True)
+        self.sweeper.start()
 
     def get(self, token):
-        if token in self.cache:
-            return self.cache.get(token)
-        else:
-            return None
+        with self.lock:
+            return self.logins.get(token)
 
     def put(self, login):
-        self.cache[login.token] = login
+        self.database.write(lambda db: db.execute(
+            'insert or replace into logins (token, username, expiry_ts) values (?, ?, ?)',
+            (login.token, login.username, login.expiry_dt.strftime(SqliteLoginDao.TIMESTAMP_FORMAT))))
+        with self.lock:
+            self._add(login)
+            evicted = []
+            while len(self.logins) > self.max_logins:
+                evicted.append(self._pop_soonest())
+            self.evicted += len(evicted)
+        self._delete(evicted)
 
     def drop(self, token):
-        del self.cache[token]
+        with self.lock:
+            self._remove(token)
+        self._delete([token])
 
     def clear_expired_logins(self):
+        """
+            Drop every login which has expired, returning how many were
+            dropped.  Expired rows are also deleted from the database,
+            including any written by other processes.
+        """
         now = datetime.now()
-        for token, login in self.cache.items():
-            if now > login.expiry_dt:
-                self.drop(token)
+        with self.lock:
+            expired = 0
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                if self._pop_soonest() is not None:
+                    expired += 1
+            self.expired += expired
+            self.sweeps += 1
+        self.database.write(lambda db: db.execute('delete from logins where expiry_ts <= ?',
+                                                  (now.strftime(SqliteLoginDao.TIMESTAMP_FORMAT),)))
+        return expired
+
+    def close(self):
+        self.stopped.set()
+        self.sweeper.join()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'logins':       len(self.logins),
+                'max_logins':   self.max_logins,
+                'bytes':        self.bytes,
+                'heap_entries': len(self.expiry_heap),
+                'loaded':       self.loaded,
+                'expired':      self.expired,
+                'evicted':      self.evicted,
+                'sweeps':       self.sweeps
+            }
+
+    def _load(self):
+        now = datetime.now().strftime(SqliteLoginDao.TIMESTAMP_FORMAT)
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select token, username, expiry_ts from logins where expiry_ts > ? '
+                      'order by expiry_ts desc limit ?', (now, self.max_logins))
+            rows = c.fetchall()
+        for token, username, expiry_ts in rows:
+            self._add(Login(username, datetime.strptime(expiry_ts, SqliteLoginDao.TIMESTAMP_FORMAT), token))
+        return len(rows)
+
+    def _add(self, login):
+        self._remove(login.token)
+        self.logins[login.token] = login
+        self.bytes += SqliteLoginDao.LOGIN_SIZE + len(login.token) + len(login.username)
+        heapq.heappush(self.expiry_heap, (login.expiry_dt, login.token))
+        if len(self.expiry_heap) > 2 * len(self.logins) + 64:
+            # Too many skipped pairs have built up, start over.
+            self.expiry_heap = [(login.expiry_dt, token) for token, login in self.logins.items()]
+            heapq.heapify(self.expiry_heap)
+
+    def _remove(self, token):
+        login = self.logins.pop(token, None)
+        if login is not None:
+            self.bytes -= SqliteLoginDao.LOGIN_SIZE + len(login.token) + len(login.username)
+
+    def _pop_soonest(self):
+        """
+            Remove the top of the expiry heap, returning its token if it
+            was a current login which has now been dropped.
+        """
+        expiry_dt, token = heapq.heappop(self.expiry_heap)
+        login = self.logins.get(token)
+        if login is None or login.expiry_dt != expiry_dt:
+            return None
+        self._remove(token)
+        return token
+
+    def _delete(self, tokens):
+        tokens = [token for token in tokens if token is not None]
+        if tokens:
+            self.database.write(lambda db: db.executemany(
+                'delete from logins where token = ?', [(token,) for token in tokens]))
+
+    def _sweep_loop(self):
+        while not self.stopped.wait(self.sweep_interval):
+            try:
+                self.clear_expired_logins()
+            except Exception:
+                self.log.exception('Failed to clear expired logins.')
 
 #--------------------------------------------------------------------
 class SqliteUserDao:
-    def __init__(self, db_conn):
-        self.db = db_conn
+    def __init__(self, database, user_cache):
+        self.database = database
+        self.user_cache = user_cache
 
     def get(self, username):
         users = self.get_users([username])
@@ -98,115 +383,648 @@ class SqliteUserDao:
             return None
 
     def get_users(self, usernames):
-        c = self.db.cursor()
-        c.execute('select * from users where username in (%s)' % (','.join('?' * len(usernames))), usernames)
-        user_map = collections.OrderedDict()
-        for row in c.fetchall():
-            user = User(*row)
-            user_map[user.username] = user
-
-        c.execute('select * from user_rights where username in (%s)' % (','.join('?' * len(usernames))), usernames)
-        for row in c.fetchall():
-            username, right = row
-            if username in user_map:
-                user_map[username].rights.add(UserRight.by_name(right))
-
-        c.execute('select * from user_attributes where username in (%s)' % (','.join('?' * len(usernames))), usernames)
-        for row in c.fetchall():
-            username, attribute = row
-            if username in user_map:
-                user_map[username].attributes.add(UserAttribute.by_name(attribute))
-
-        return list(user_map.values())
+        """
+            Get users by username, from the user cache where possible.
+            Callers get their own copies of cached users, which they
+            are free to modify.
+        """
+        user_map = collections.OrderedDict((username, self.user_cache.get(username)) for username in usernames)
+        missing = [username for username, user in user_map.items() if user is None]
+
+        if missing:
+            generation = self.user_cache.generation
+            for user in self._fetch_users(missing):
+                self.user_cache.put(user.username, generation, user)
+                user_map[user.username] = user
+
+        return [User(user.username, user.passhash, user.rights, user.attributes, user.login_generation)
+                for user in user_map.values() if user is not None]
+
+    def _fetch_users(self, usernames):
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select username, passhash, login_generation, '
+                      '(select group_concat(app_right) from user_rights where username = users.username), '
+                      '(select group_concat(attribute) from user_attributes where username = users.username) '
+                      'from users where username in (%s)' % (','.join('?' * len(usernames))), usernames)
+            users = []
+            for username, passhash, login_generation, rights, attributes in c.fetchall():
+                users.append(User(username, passhash,
+                    [UserRight.by_name(right) for right in (rights or '').split(',') if right],
+                    [UserAttribute.by_name(attribute) for attribute in (attributes or '').split(',') if attribute],
+                    login_generation))
+            return users
 
     def put(self, user):
-        c = self.db.cursor()
-        c.execute('insert or replace into users (username, passhash) values (?, ?)', (user.username, user.passhash))
-        c.execute('delete from user_rights where username = ?', (user.username,))
-        c.execute('delete from user_attributes where username = ?', (user.username,))
-        for right in user.rights:
-            c.execute('insert into user_rights (username, app_right) values (?, ?)', (user.username, str(right)))
-        for attribute in user.attributes:
-            c.execute('insert into user_attributes (username, attribute) values (?, ?)', (user.username, str(attribute)))
-        self.db.commit()
+        """
+            Save a user, upserting the row in place and writing only the
+            rights and attributes which changed.  Raises UsernameTaken
+            if another user's name differs from this one only by case.
+        """
+        def put(db):
+            c = db.cursor()
+            tag = user_tag(user.username)
+            c.execute('select username from users where user_tag = ? and username != ?', (tag, user.username))
+            row = c.fetchone()
+            if row is not None:
+                raise UsernameTaken(row[0])
+            c.execute('insert into users (username, passhash, user_tag) values (?, ?, ?) '
+                      'on conflict(username) do update set passhash = excluded.passhash',
+                      (user.username, user.passhash, tag))
+            self._put_set(c, 'user_rights', 'app_right', user.username, user.rights)
+            self._put_set(c, 'user_attributes', 'attribute', user.username, user.attributes)
+        self.database.write(put)
+        self.user_cache.invalidate(user.username)
+
+    def bump_login_generation(self, user):
+        """
+            Revoke every signed login token issued to the user so far,
+            updating the user's login_generation.
+        """
+        def bump(db):
+            c = db.cursor()
+            c.execute('update users set login_generation = login_generation + 1 where username = ?',
+                      (user.username,))
+            c.execute('select login_generation from users where username = ?', (user.username,))
+            return c.fetchone()[0]
+        user.login_generation = self.database.write(bump)
+        self.user_cache.invalidate(user.username)
+
+    def _put_set(self, c, table, column, username, values):
+        c.execute('select {column} from {table} where username = ?'.format(
+            table = table, column = column), (username,))
+        stored = set(row[0] for row in c.fetchall())
+        values = set(str(value) for value in values)
+        c.executemany('delete from {table} where username = ? and {column} = ?'.format(
+            table = table, column = column), [(username, value) for value in stored - values])
+        c.executemany('insert into {table} (username, {column}) values (?, ?)'.format(
+            table = table, column = column), [(username, value) for value in values - stored])
+
+#--------------------------------------------------------------------
+class OriginalMissing(Exception):
+    """
+        Raised when an imported image was to share a stored original
+        which has since been deleted, so it has to be imported itself.
+    """
+    def __init__(self, blob_hash):
+        super().__init__('The stored original %s no longer exists.' % blob_hash)
+        self.blob_hash = blob_hash
 
 #--------------------------------------------------------------------
 class SqliteImageDao:
-    def __init__(self, log, db_conn, image_dir, image_page_size):
-        self.db = db_conn
+    # Most ids bound to a single 'in' clause.
+    MAX_PARAMS = 500
+
+    def __init__(self, log, database, image_dir, image_page_size, tag_index, search_cache,
+                 ingest_pool, animated_previews_enabled, animated_webp_enabled, date_tags_enabled):
+        self.database = database
         self.image_dir = image_dir
         self.image_page_size = image_page_size
+        self.tag_index = tag_index
+        self.search_cache = search_cache
+        self.ingest_pool = ingest_pool
+        self.animated_previews_enabled = animated_previews_enabled
+        self.animated_webp_enabled = animated_webp_enabled
+        self.date_tags_enabled = date_tags_enabled
         self.log = log
 
-        mini_dir = os.path.join(self.image_dir, 'mini')
-        if not os.path.exists(mini_dir):
-            os.makedirs(mini_dir)
-    
+        for subdir in ('mini', 'preview', 'anim'):
+            path = os.path.join(self.image_dir, subdir)
+            if not os.path.exists(path):
+                os.makedirs(path)
+
     def get_image_filenames(self, image):
         image_filename = os.path.join(self.image_dir, image.get_filename())
         mini_filename = os.path.join(self.image_dir, 'mini', image.get_filename())
         return image_filename, mini_filename
 
+    def get_animation_filenames(self, image):
+        """
+            The animated preview and WebP filenames for an image, or
+            None for each that shouldn't be generated.
+        """
+        preview_filename, webp_filename = self._get_animation_filenames(image)
+        if image.mime_type != 'image/gif' or not self.animated_previews_enabled:
+            preview_filename = None
+        if image.mime_type != 'image/gif' or not self.animated_webp_enabled:
+            webp_filename = None
+        return preview_filename, webp_filename
+
+    def _get_animation_filenames(self, image):
+        return (os.path.join(self.image_dir, 'preview', image.get_file_id() + '.gif'),
+                os.path.join(self.image_dir, 'anim', image.get_file_id() + '.webp'))
+
+    def _remove_derived_files(self, image):
+        image_filename, mini_filename = self.get_image_filenames(image)
+        for filename in (mini_filename,) + self._get_animation_filenames(image):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def batch(self, fn):
+        """
+            Call fn, making every write it does through this DAO in a
+            single transaction.
+        """
+        result = self.database.write(lambda db: fn())
+        self.search_cache.invalidate()
+        return result
+
     def save_new_image(self, image_file, summary, tags):
+        """
+            Store an uploaded image and queue it for thumbnailing and
+            metadata tagging.  The image is saved with the processing
+            tag until the ingest pool finishes with it.
+
+            Originals are content addressed: if the same bytes were
+            uploaded before, the new image shares the stored original,
+            thumbnail and metadata rather than decoding it again.
+        """
         image = Image(mime_type = str(image_file.content_type), summary = summary, tags = tags)
         image_filename, mini_filename = self.get_image_filenames(image)
+        digest = hashlib.sha256()
 
         with open(image_filename, 'wb') as outfile:
             while True:
                 data = image_file.file.read(8192)
                 if not data:
                     break
+                digest.update(data)
                 outfile.write(data)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+
+        image.add_tags(Image.PROCESSING_TAG)
+
+        def save():
+            duplicate = self._link_blob(image, digest.hexdigest())
+            metadata_map = self._get_blob_metadata(image) if duplicate else None
+            if metadata_map:
+                image.tags.discard(Image.PROCESSING_TAG)
+                self._apply_metadata(image, metadata_map)
+                self.save_metadata(image, metadata_map)
+            self.save_image(image)
+            return duplicate, metadata_map
+
+        duplicate, metadata_map = self.batch(save)
+
+        if duplicate:
+            os.remove(image_filename)
+            if metadata_map:
+                return image
+
+            # The original upload is still being processed, so only
+            # its metadata is needed for this copy.
+            image_filename = self.get_image_filenames(image)[0]
+            mini_filename = preview_filename = webp_filename = None
+
+        else:
+            preview_filename, webp_filename = self.get_animation_filenames(image)
 
-        # TODO: this definitely can't handle gifv, let's try to support that someday
-        with wand.image.Image(filename = image_filename) as wand_image:
-            wand_image.transform(resize = Image.THUMB_RESIZE_TRANSFORM)
-            wand_image.save(filename = mini_filename)
+        if not self.ingest_pool.submit(image, image_filename, mini_filename,
+                                       preview_filename, webp_filename):
+            # The pool is saturated, so make this request pay for it.
+            self.log.warn('Ingest queue is full, processing image %s inline.' % image.id)
+            self.finish_processing(image, ingest_image(
+                image_filename, mini_filename,
+                preview_filename = preview_filename, webp_filename = webp_filename))
 
-        image.populate_from_metadata(self.get_metadata(image))
-        self.save_image(image)
         return image
 
+    def save_imported_image(self, image, blob_hash, result = None):
+        """
+            Save an image whose original was copied into the image
+            directory by a bulk import, along with its ingest result.
+            If the content is already stored, the image is linked to the
+            existing original and shares its metadata instead, and True
+            is returned.  The caller removes any files it copied.
+
+            Without an ingest result, raises OriginalMissing before
+            writing anything if the original it was to share is gone.
+        """
+        def save():
+            if result is None and not self.has_blob(blob_hash):
+                raise OriginalMissing(blob_hash)
+            duplicate = self._link_blob(image, blob_hash)
+            if duplicate:
+                metadata_map = self._get_blob_metadata(image)
+                self.save_metadata(image, metadata_map)
+            else:
+                metadata_map = self.save_ingest_result(image, result)
+            self._apply_metadata(image, metadata_map)
+            self.save_image(image)
+            return duplicate
+
+        return self.batch(save)
+
+    def link_existing_image(self, image, blob_hash):
+        """
+            Record the content hash of an image stored before originals
+            were content addressed.  If another image already holds the
+            same content, this image is linked to it and its own files
+            are removed.  Returns True if the image was a duplicate.
+        """
+        own_files = self.get_image_filenames(image) + self._get_animation_filenames(image)
+
+        def link():
+            duplicate = self._link_blob(image, blob_hash)
+            if duplicate:
+                metadata_map = self._get_blob_metadata(image)
+                if metadata_map:
+                    self.save_metadata(image, metadata_map)
+            return duplicate
+
+        if not self.batch(link):
+            return False
+
+        for filename in own_files:
+            if os.path.exists(filename):
+                os.remove(filename)
+        return True
+
+    def get_unlinked_image_ids(self):
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select id from images where id not in (select id from image_blobs) order by ts, id')
+            return [row[0] for row in c.fetchall()]
+
+    def has_blob(self, blob_hash):
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select 1 from blobs where hash = ?', (blob_hash,))
+            return c.fetchone() is not None
+
+    def get_stored_filenames(self):
+        """
+            A map from every image id to the filename of its original.
+        """
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select images.id, images.mime_type, blobs.filename from images '
+                      'left join image_blobs on image_blobs.id = images.id '
+                      'left join blobs on blobs.hash = image_blobs.hash')
+            return {id: filename or id + Image.MIME_EXT_MAP[mime_type]
+                    for id, mime_type, filename in c}
+
+    def get_blob_filenames(self):
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select filename from blobs')
+            return set(row[0] for row in c.fetchall())
+
+    def _link_blob(self, image, blob_hash):
+        """
+            Add a reference from the image to the blob with the given
+            content hash, creating the blob from the image's original if
+            it doesn't exist.  When the blob already exists, the image
+            is pointed at its original and True is returned.
+        """
+        def link(db):
+            c = db.cursor()
+            c.execute('insert or ignore into blobs (hash, filename, refcount) values (?, ?, 0)',
+                      (blob_hash, image.get_filename()))
+            duplicate = c.rowcount == 0
+            if duplicate:
+                c.execute('select filename from blobs where hash = ?', (blob_hash,))
+                image.filename = c.fetchone()[0]
+            c.execute('update blobs set refcount = refcount + 1 where hash = ?', (blob_hash,))
+            c.execute('insert into image_blobs (id, hash) values (?, ?)', (image.id, blob_hash))
+            return duplicate
+
+        return self.database.write(link)
+
+    def _unlink_blob(self, image):
+        """
+            Drop the image's reference to its blob.  Returns True if the
+            image's files are no longer referenced and can be removed.
+        """
+        def unlink(db):
+            c = db.cursor()
+            c.execute('select hash from image_blobs where id = ?', (image.id,))
+            row = c.fetchone()
+            if row is None:
+                # Stored before originals were content addressed.
+                return True
+
+            blob_hash = row[0]
+            c.execute('delete from image_blobs where id = ?', (image.id,))
+            c.execute('update blobs set refcount = refcount - 1 where hash = ?', (blob_hash,))
+            c.execute('delete from blobs where hash = ? and refcount <= 0', (blob_hash,))
+            return c.rowcount > 0
+
+        return self.database.write(unlink)
+
+    def _get_blob_metadata(self, image):
+        """
+            Metadata already stored for another image sharing this
+            image's original, if any.
+        """
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select key, value from image_metadata where id = ('
+                      'select shared.id from image_blobs as shared, image_blobs as own '
+                      'where own.id = ? and shared.hash = own.hash and shared.id != own.id '
+                      'and exists (select 1 from image_metadata where image_metadata.id = shared.id) '
+                      'limit 1)', (image.id,))
+            return {key: value for key, value in c.fetchall()}
+
+    def _apply_metadata(self, image, metadata_map):
+        image.populate_from_metadata(metadata_map, self.date_tags_enabled)
+        if int(metadata_map.get(Image.FRAMES_KEY, 1)) > 1:
+            image.add_tags(Image.ANIMATED_TAG)
+
+    def finish_processing(self, uploaded_image, result):
+        def finish():
+            image = self.get(uploaded_image.id)
+            if image is None:
+                return False
+            image.tags.discard(Image.PROCESSING_TAG)
+            self._apply_metadata(image, self.save_ingest_result(image, result))
+            self.save_image(image)
+            return True
+
+        if not self.batch(finish):
+            # The image was deleted while it was being processed.
+            if uploaded_image.get_filename() not in self.get_blob_filenames():
+                self._remove_derived_files(uploaded_image)
+
+    def fail_processing(self, uploaded_image):
+        def fail():
+            image = self.get(uploaded_image.id)
+            if image is not None:
+                image.tags.discard(Image.PROCESSING_TAG)
+                image.add_tags(Image.PROCESSING_FAILED_TAG)
+                self.save_image(image)
+
+        self.batch(fail)
+
+    def resume_processing(self):
+        """
+            Requeue images left in the processing state, e.g. by a
+            server restart.
+        """
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select id from image_tags where tag = ?', (Image.PROCESSING_TAG,))
+            image_ids = [row[0] for row in c.fetchall()]
+
+        images = self.get_images(image_ids)
+        for image in images:
+            image_filename, mini_filename = self.get_image_filenames(image)
+            preview_filename, webp_filename = self.get_animation_filenames(image)
+            if not self.ingest_pool.submit(image, image_filename, mini_filename,
+                                           preview_filename, webp_filename):
+                break
+        return len(images)
+
     def delete_image(self, image):
         image_filename, mini_filename = self.get_image_filenames(image)
-        c = self.db.cursor()
-        c.execute('delete from images where id = ?', (image.id,))
-        os.remove(image_filename)
-        os.remove(mini_filename)
-        self.db.commit()
+
+        def delete(db):
+            # The blob link has to be read before the delete cascades
+            # to image_blobs, image_tags and image_metadata.
+            before = self._library_generation(db)
+            unreferenced = self._unlink_blob(image)
+            db.execute('delete from images where id = ?', (image.id,))
+            if self.tag_index is not None:
+                after = self._library_generation(db)
+                self.database.after_commit(lambda: self.tag_index.remove(image.id, before, after))
+            return unreferenced
+
+        # Files are only removed once the delete is committed.
+        if self.database.write(delete):
+            os.remove(image_filename)
+            self._remove_derived_files(image)
+        self.search_cache.invalidate()
 
     def get_metadata(self, image):
-        metadata_map = {}
+        """
+            Get the stored metadata for an image.  Use refresh_metadata
+            to decode the original again.
+        """
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select key, value from image_metadata where id = ?', (image.id,))
+            return {key: value for key, value in c.fetchall()}
+
+    def refresh_metadata(self, image):
         image_filename = os.path.join(self.image_dir, image.get_filename())
+        return self.save_ingest_result(image, ingest_image(image_filename))
 
-        with wand.image.Image(filename = image_filename) as wand_image:
-            try:
-                for key, value in wand_image.metadata.items():
-                    metadata_map[key] = value
-            except Exception as e:
-                self.log.exception("Failed to parse image metadata for image %s." % image.id)
-                image.add_tags('flag:metadata_exception')
+    def get_metadata_maps(self, image_ids):
+        """
+            Get the stored metadata for many images at once, as a map
+            of image id to metadata map.  Images with no stored
+            metadata are left out.
+        """
+        if not image_ids:
+            return {}
+
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select id, key, value from image_metadata where id in (%s)' % (','.join('?' * len(image_ids))), image_ids)
+            metadata_maps = collections.defaultdict(dict)
+            for id, key, value in c.fetchall():
+                metadata_maps[id][key] = value
+        return dict(metadata_maps)
+
+    def save_metadata(self, image, metadata_map):
+        def save(db):
+            c = db.cursor()
+            c.execute('delete from image_metadata where id = ?', (image.id,))
+            c.executemany('insert into image_metadata (id, key, value) values(?, ?, ?)',
+                          [(image.id, key, str(value)) for key, value in metadata_map.items()])
 
+        self.database.write(save)
+
+    def save_ingest_result(self, image, result):
+        if result.error is not None:
+            self.log.error('Failed to parse image metadata for image %s.\n%s' % (image.id, result.error))
+            image.add_tags('flag:metadata_exception')
+        metadata_map = result.get_metadata()
+        self.save_metadata(image, metadata_map)
         return metadata_map
 
+    def get_image_ids_after(self, after_id, limit):
+        """
+            A batch of image ids in id order, starting after the given
+            id, for walking the whole library by keyset.
+        """
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select id from images where id > ? order by id limit ?', (after_id or '', limit))
+            return [row[0] for row in c.fetchall()]
+
+    def count_images_after(self, after_id):
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select count(*) from images where id > ?', (after_id or '',))
+            return c.fetchone()[0]
+
+    def get_checkpoint(self, name):
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select value from checkpoints where name = ?', (name,))
+            row = c.fetchone()
+            return row[0] if row is not None else None
+
+    def set_checkpoint(self, name, value):
+        self.database.write(lambda db: db.execute(
+            'insert or replace into checkpoints (name, value) values(?, ?)', (name, value)))
+
+    def clear_checkpoint(self, name):
+        self.database.write(lambda db: db.execute(
+            'delete from checkpoints where name = ?', (name,)))
+
     def save_image(self, image):
-        c = self.db.cursor()
-        c.execute('insert or replace into images(id, mime_type, summary, ts, create_ts) values(?, ?, ?, ?, ?)', (image.id, image.mime_type, image.summary, image.timestamp, image.create_timestamp))
-        c.execute('delete from image_tags where id = ?', (image.id,))
-        for tag in image.tags:
-            # TODO: this can be done more optimally with a batch insert or replace
-            c.execute('insert into image_tags (id, tag) values(?, ?)', (image.id, tag))
-        self.db.commit()
-
-    def find(self, tags, ntags, limit = None, offset = 0):
+        self.save_images([image])
+
+    def save_images(self, images):
+        """
+            Save many images in a single transaction.  Rows are upserted
+            in place and only the tags which changed since the images
+            were last saved are written.
+        """
+        if not images:
+            return
+
+        for image in images:
+            image.tags = normalize_tags(image.tags)
+
+        def save(db):
+            c = db.cursor()
+            before = self._library_generation(db)
+            c.executemany('insert into images(id, mime_type, summary, ts, create_ts) values(?, ?, ?, ?, ?) '
+                          'on conflict(id) do update set mime_type = excluded.mime_type, '
+                          'summary = excluded.summary, ts = excluded.ts, create_ts = excluded.create_ts',
+                          [(image.id, image.mime_type, image.summary, image.timestamp, image.create_timestamp)
+                           for image in images])
+
+            stored_tags = self._get_stored_tags(c, [image.id for image in images])
+            removed = []
+            added = []
+            for image in images:
+                old_tags = stored_tags.get(image.id, set())
+                removed.extend((image.id, tag) for tag in old_tags - image.tags)
+                added.extend((image.id, tag) for tag in image.tags - old_tags)
+            c.executemany('delete from image_tags where id = ? and tag = ?', removed)
+            c.executemany('insert into image_tags (id, tag) values(?, ?)', added)
+
+            if self.tag_index is not None:
+                # The index is updated only once the images are
+                # committed, as they were when saved.
+                saved = [self._snapshot(image) for image in images]
+                after = self._library_generation(db)
+                self.database.after_commit(lambda: self.tag_index.update(saved, before, after))
+
+        self.database.write(save)
+        self.search_cache.invalidate()
+
+    def _snapshot(self, image):
+        snapshot = copy.copy(image)
+        snapshot.tags = set(image.tags)
+        return snapshot
+
+    def _library_generation(self, db):
+        return db.execute('select generation from library_state').fetchone()[0]
+
+    def _get_stored_tags(self, c, image_ids):
+        stored_tags = collections.defaultdict(set)
+        for n in range(0, len(image_ids), SqliteImageDao.MAX_PARAMS):
+            chunk = image_ids[n:n + SqliteImageDao.MAX_PARAMS]
+            c.execute('select id, tag from image_tags where id in (%s)' % (','.join('?' * len(chunk))), chunk)
+            for id, tag in c.fetchall():
+                stored_tags[id].add(tag)
+        return stored_tags
+
+    def get_tag_stats(self, limit = None):
+        """
+            Get (tag, image count) pairs, most used tags first.
+        """
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select tag, image_count from tag_stats order by image_count desc, tag limit ?',
+                      (-1 if limit is None else limit,))
+            return c.fetchall()
+
+    def rebuild_text_index(self):
+        """
+            Re-index the summaries of every image for text search.
+        """
+        self.database.write(lambda db: db.execute("insert into image_text (image_text) values ('rebuild')"))
+        self.search_cache.invalidate()
+
+    def find(self, query, limit = None, offset = 0, cursor = None, sort = SortOrder.UPLOADED):
+        """
+            Find a page of images matching a parsed query, newest first
+            by the given SortOrder, along with the total number of
+            matching images.  See parse_query and tag_list_query.
+        """
         if limit is None:
             limit = self.image_page_size
 
-        c = self.db.cursor()
-        c.execute(self._build_select_count_query(tags, ntags), tags + ntags)
+        key = self.search_cache.key(query, limit, offset, cursor, sort)
+        result = self.search_cache.get(key)
+        if result is not None:
+            return result
+
+        generation = self.search_cache.generation
+        images, count = self._find(query, limit, offset, cursor, sort)
+        self.search_cache.put(key, generation, images, count)
+        return images, count
+
+    def _find(self, query, limit, offset, cursor, sort):
+        if self.tag_index is not None:
+            with self.database.read() as db:
+                result = self.tag_index.find(db, query, limit, offset, cursor, sort)
+            if result is not None:
+                ids, count = result
+                return self.get_images(ids), count
+
+        with self.database.read() as db:
+            c = db.cursor()
+            counts = tag_query_compiler.get_counts(c, query)
+            if query.estimate(counts) == 0:
+                # Some part of the query can't match any image.
+                return [], 0
+
+            # Ranked results are paged by offset, as cursors only hold
+            # the position of an image in time.
+            if cursor is not None and tag_query_compiler.ranked_term(query, sort) is None:
+                ids, count = self._find_keyset(c, query, counts, limit, cursor, sort)
+
+            else:
+                sql, params = tag_query_compiler.compile_select(query, counts, sort)
+                c.execute(sql, params + tag_query_compiler.page_params(limit, offset))
+                rows = c.fetchall()
+                ids = [row[0] for row in rows]
+
+                if rows:
+                    count = rows[0][1]
+                elif offset > 0:
+                    # The window count is only available alongside a page of
+                    # results, so count separately when paging past the end.
+                    c.execute(*tag_query_compiler.compile_count(query, counts))
+                    count = c.fetchone()[0]
+                else:
+                    count = 0
+
+        return self.get_images(ids), count
+
+    def _find_keyset(self, c, query, counts, limit, cursor, sort):
+        c.execute(*tag_query_compiler.compile_count(query, counts))
         count = c.fetchone()[0]
-        c.execute(self._build_select_query(tags, ntags, limit, offset), tags + ntags)
-        return self.get_images([x[0] for x in c.fetchall()]), count
+
+        offset = cursor.skip
+        if cursor.direction == Cursor.LAST:
+            limit, offset = last_page_size(count, limit), 0
+
+        sql, params = tag_query_compiler.compile_keyset_select(query, counts, cursor.direction, sort)
+        c.execute(sql, params + tag_query_compiler.page_params(limit, offset, cursor))
+        ids = [row[0] for row in c.fetchall()]
+
+        if cursor.direction != Cursor.AFTER:
+            ids.reverse()
+        return ids, count
 
     def get(self, image_id):
        images = self.get_images([image_id])
@@ -219,48 +1037,22 @@ class SqliteImageDao:
         if not image_ids:
             return []
 
-        c = self.db.cursor()
-        c.execute('select * from images where id in (%s)' % (','.join('?' * len(image_ids))), image_ids)
-        image_map = collections.OrderedDict()
-        for row in c.fetchall():
-            image = Image(*row)
-            image_map[image.id] = image
-
-        c.execute('select * from image_tags where id in (%s)' % (','.join('?' * len(image_ids))), image_ids)
-
-        for row in c.fetchall():
-            id, tag = row
-            if id in image_map:
-                image_map[id].tags.add(tag)
-
-        return list(image_map.values())
-
-    def _build_select_count_query(self, tags, ntags):
-        query = 'select count(*) from images where {tag_queries} and {ntag_queries}'
-        return query.format(
-            tag_queries = self._build_tag_subquery(tags),
-            ntag_queries = self._build_tag_subquery(ntags, eq = False))
-
-    def _build_select_query(self, tags, ntags, limit, offset):
-        query = 'select id from images where {tag_queries} and {ntag_queries} order by images.ts desc limit %d offset %d' % (limit, offset)
-        return query.format(
-            tag_queries = self._build_tag_subquery(tags),
-            ntag_queries = self._build_tag_subquery(ntags, eq = False))
-
-    def _build_tag_subquery(self, tags, eq = True):
-        subqueries = []
-        if not tags:
-            return '1'
-
-        subquery = None
-        if eq:
-            subquery = 'id in ({subselect})'
-        else:
-            subquery = 'id not in ({subselect})'
+        with self.database.read() as db:
+            c = db.cursor()
+            c.execute('select images.id, mime_type, summary, ts, create_ts, blobs.filename from images '
+                      'left join image_blobs on image_blobs.id = images.id '
+                      'left join blobs on blobs.hash = image_blobs.hash '
+                      'where images.id in (%s)' % (','.join('?' * len(image_ids))), image_ids)
+            image_map = collections.OrderedDict()
+            for row in c.fetchall():
+                image = Image(*row[:5], filename = row[5])
+                image_map[image.id] = image
 
-        for tag in tags:
-            subqueries.append(subquery.format(
-                subselect = 'select id from image_tags where tag collate nocase = ?'))
+            c.execute('select * from image_tags where id in (%s)' % (','.join('?' * len(image_ids))), image_ids)
 
-        return ' and '.join(subqueries)
+            for row in c.fetchall():
+                id, tag = row
+                if id in image_map:
+                    image_map[id].tags.add(tag)
 
+        return [image_map[id] for id in image_ids if id in image_map]
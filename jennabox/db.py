@@ -0,0 +1,262 @@
+#--------------------------------------------------------------------
+# JennaBox: A lightweight privacy-focused image tagging and
+#           sharing website.
+#
+# Author: Lain Supe (lainproliant)
+# Date: Tuesday, August 23rd 2016
+#--------------------------------------------------------------------
+
+import contextlib
+import queue
+import sqlite3
+import threading
+import time
+import urllib.request
+
+from .metrics import Timing
+
+#--------------------------------------------------------------------
+# Prepared statements kept per connection.  Search SQL differs for each
+# query shape, so this is larger than the sqlite3 default of 128.
+STATEMENT_CACHE_SIZE = 512
+
+#--------------------------------------------------------------------
+class WriteJob:
+    def __init__(self, fn):
+        self.fn = fn
+        self.submitted = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.after_commit = []
+
+#--------------------------------------------------------------------
+class ConnectionManager:
+    """
+        Owns every sqlite connection to the JennaBox database.
+
+        The database is used in WAL mode, so readers never wait for the
+        writer.  Reads use a bounded pool of read-only connections.
+        Writes are callables run one at a time by a single writer
+        thread, which commits each batch of queued writes together.
+        Writes made from within a write, and reads made from within a
+        write, run inline on the writer's connection.  A write can ask
+        for a callback once it is committed, see after_commit().  Reads made from
+        within a read reuse the thread's read connection, so that a
+        thread never waits on itself for a reader slot.
+    """
+
+    def __init__(self, log, db_file, max_readers = 8, max_batch = 64,
+                 mmap_size = 256 * 1024 * 1024, cache_kib = 16 * 1024,
+                 busy_timeout_ms = 5000):
+        self.log = log
+        self.db_file = db_file
+        self.max_readers = max_readers
+        self.max_batch = max_batch
+        self.mmap_size = mmap_size
+        self.cache_kib = cache_kib
+        self.busy_timeout_ms = busy_timeout_ms
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.readers = queue.LifoQueue()
+        self.reader_slots = threading.BoundedSemaphore(max_readers)
+        self.open_readers = 0
+        self.jobs = queue.Queue()
+        self.batches = 0
+        self.writes = 0
+        self.failed_writes = 0
+        self.read_wait_timing = Timing()
+        self.write_wait_timing = Timing()
+        self.commit_timing = Timing()
+
+        self.write_conn = self.connect(read_only = False)
+        self.closed = False
+        self.writer = threading.Thread(target = self._write_loop,
+                                       name = 'jennabox-db-writer', daemon = True)
+        self.writer.start()
+
+    def connect(self, read_only):
+        if read_only:
+            conn = sqlite3.connect('file:%s?mode=ro' % urllib.request.pathname2url(self.db_file),
+                                   uri = True, check_same_thread = False,
+                                   cached_statements = STATEMENT_CACHE_SIZE)
+        else:
+            # Transactions on the writer are begun and committed explicitly.
+            conn = sqlite3.connect(self.db_file, check_same_thread = False,
+                                   isolation_level = None, cached_statements = STATEMENT_CACHE_SIZE)
+            conn.execute('pragma journal_mode = wal')
+            conn.execute('pragma synchronous = normal')
+            conn.execute('pragma foreign_keys = on')
+        conn.execute('pragma busy_timeout = %d' % self.busy_timeout_ms)
+        conn.execute('pragma mmap_size = %d' % self.mmap_size)
+        conn.execute('pragma cache_size = -%d' % self.cache_kib)
+        return conn
+
+    def in_writer(self):
+        return getattr(self.local, 'writing', False)
+
+    @contextlib.contextmanager
+    def read(self):
+        """
+            Borrow a read-only connection for the duration of a with
+            block.  Waits if all max_readers connections are in use.
+        """
+        if self.in_writer():
+            yield self.write_conn
+            return
+
+        conn = getattr(self.local, 'reader', None)
+        if conn is not None:
+            yield conn
+            return
+
+        started = time.time()
+        self.reader_slots.acquire()
+        self.read_wait_timing.record(time.time() - started)
+        try:
+            try:
+                conn = self.readers.get_nowait()
+            except queue.Empty:
+                conn = self.connect(read_only = True)
+                with self.lock:
+                    self.open_readers += 1
+
+            self.local.reader = conn
+            try:
+                yield conn
+            finally:
+                self.local.reader = None
+                if conn.in_transaction:
+                    conn.rollback()
+                self.readers.put(conn)
+        finally:
+            self.reader_slots.release()
+
+    def write(self, fn):
+        """
+            Run fn(conn) on the writer connection and wait until its
+            changes are committed, returning its result.  If fn raises,
+            its changes are rolled back and the exception is re-raised
+            here without affecting other writes in the same batch.
+        """
+        if self.in_writer():
+            return fn(self.write_conn)
+        if self.closed:
+            raise RuntimeError('The database connection manager is closed.')
+
+        job = WriteJob(fn)
+        self.jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def after_commit(self, fn):
+        """
+            Call fn on the writer thread once the write being run is
+            committed, before that write returns.  If the write is
+            rolled back, fn is never called.  Used to keep in-memory
+            state such as the tag index in step with the database.
+        """
+        job = getattr(self.local, 'job', None)
+        if job is None:
+            raise RuntimeError('after_commit() must be called from within a write.')
+        job.after_commit.append(fn)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.jobs.put(None)
+        self.writer.join()
+        self.write_conn.close()
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_readers':      self.max_readers,
+                'open_readers':     self.open_readers,
+                'idle_readers':     self.readers.qsize(),
+                'write_queue':      self.jobs.qsize(),
+                'writes':           self.writes,
+                'failed_writes':    self.failed_writes,
+                'batches':          self.batches,
+                'writes_per_batch': float(self.writes) / self.batches if self.batches else 0.0,
+                'read_wait':        self.read_wait_timing.stats(),
+                'write_wait':       self.write_wait_timing.stats(),
+                'commit':           self.commit_timing.stats()
+            }
+
+    def _write_loop(self):
+        self.local.writing = True
+        stopping = False
+        while not stopping:
+            job = self.jobs.get()
+            if job is None:
+                break
+
+            batch = [job]
+            while len(batch) < self.max_batch:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                self.log.exception('Failed to commit a batch of %d writes.' % len(batch))
+                if self.write_conn.in_transaction:
+                    self.write_conn.execute('rollback')
+                self._finish_batch(batch, e)
+
+    def _write_batch(self, batch):
+        conn = self.write_conn
+        conn.execute('begin immediate')
+        for job in batch:
+            self.write_wait_timing.record(time.time() - job.submitted)
+            conn.execute('savepoint write_job')
+            self.local.job = job
+            try:
+                job.result = job.fn(conn)
+                conn.execute('release write_job')
+            except Exception as e:
+                job.error = e
+                job.after_commit = []
+                conn.execute('rollback to write_job')
+                conn.execute('release write_job')
+            finally:
+                self.local.job = None
+
+        started = time.time()
+        conn.execute('commit')
+        self.commit_timing.record(time.time() - started)
+        for job in batch:
+            for fn in job.after_commit:
+                try:
+                    fn()
+                except Exception:
+                    self.log.exception('A post-commit callback failed.')
+        self._finish_batch(batch)
+
+    def _finish_batch(self, batch, error = None):
+        with self.lock:
+            self.batches += 1
+            for job in batch:
+                if error is not None and job.error is None:
+                    job.error = error
+                self.writes += 1
+                if job.error is not None:
+                    self.failed_writes += 1
+        for job in batch:
+            job.done.set()
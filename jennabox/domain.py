@@ -6,6 +6,7 @@
 # Date: Tuesday, August 23rd 2016
 #--------------------------------------------------------------------
 
+import unicodedata
 import uuid
 from datetime import datetime
 from xenum import xenum, sref, ctor
@@ -14,6 +15,35 @@ from dateutil.parser import parse as parse_dt
 
 from .markup import *
 
+#--------------------------------------------------------------------
+def normalize_tag(tag):
+    """
+        The stored form of a tag: trimmed, case folded and NFC
+        normalized, so that tags compare equal exactly when they look
+        the same to a user and can be matched with a plain index seek.
+    """
+    return unicodedata.normalize('NFC', tag.strip().casefold())
+
+#--------------------------------------------------------------------
+def normalize_tags(tags):
+    normalized = set(normalize_tag(tag) for tag in tags)
+    normalized.discard('')
+    return normalized
+
+#--------------------------------------------------------------------
+def user_tag(username):
+    """
+        The tag marking a user's images.  Usernames which differ only
+        by case share a tag, so they can't both be registered.
+    """
+    return normalize_tag('user:%s' % username)
+
+#--------------------------------------------------------------------
+class UsernameTaken(Exception):
+    def __init__(self, username):
+        super().__init__('The username "%s" is already taken.' % username)
+        self.username = username
+
 #--------------------------------------------------------------------
 class LoginFailure(Exception):
     pass
@@ -66,11 +96,13 @@ class Action:
 #--------------------------------------------------------------------
 class User:
     def __init__(self, username, passhash = None, rights = None,
-                 attributes = None):
+                 attributes = None, login_generation = 0):
         self.username = username
         self.passhash = passhash
         self.rights = set(rights or set())
         self.attributes = set(attributes or set())
+        # Bumped to revoke every signed login token issued to the user.
+        self.login_generation = login_generation
         self.guest = False
 
     def add_attribute(self, attr):
@@ -111,7 +143,7 @@ class User:
         self.require_right([right])
 
     def get_tag(self):
-        return 'user:%s' % self.username
+        return user_tag(self.username)
 
     def is_guest(self):
         return self.guest
@@ -122,10 +154,12 @@ User.ALL = 'user:all'
 
 #--------------------------------------------------------------------
 class Login:
-    def __init__(self, username, expiry_dt, token = None):
+    def __init__(self, username, expiry_dt, token = None, generation = None):
         self.username = username
         self.expiry_dt = expiry_dt
         self.token = token or uuid.uuid4().urn[9:]
+        # The user's login generation when a signed token was issued.
+        self.generation = generation
 
     def is_valid(self):
         return datetime.now() < self.expiry_dt
@@ -138,14 +172,39 @@ class Image:
         'image/gif':    '.gif'
     }
 
+    # Extensions recognized when importing files, lower case.
+    EXT_MIME_MAP = {
+        '.jpg':         'image/jpeg',
+        '.jpeg':        'image/jpeg',
+        '.png':         'image/png',
+        '.gif':         'image/gif'
+    }
+
     THUMB_RESIZE_TRANSFORM = '300x400>'
 
+    # Smallest size JPEGs are decoded at when making thumbnails.
+    THUMB_DECODE_SIZE = '600x800'
+
+    WIDTH_KEY = 'jennabox:width'
+    HEIGHT_KEY = 'jennabox:height'
+    BYTE_SIZE_KEY = 'jennabox:size'
+    FRAMES_KEY = 'jennabox:frames'
+    WEBP_KEY = 'jennabox:webp'
+
+    # Animated previews keep at most this many frames.
+    PREVIEW_MAX_FRAMES = 24
+
+    ANIMATED_TAG = 'flag:animated'
+
+    PROCESSING_TAG = 'flag:processing'
+    PROCESSING_FAILED_TAG = 'flag:processing-failed'
+
     @staticmethod
     def parse_exif_dt(exif_dt):
         return datetime.strptime(exif_dt, '%Y:%m:%d %H:%M:%S')
 
     def __init__(self, id = None, mime_type = None, summary = None, timestamp = None,
-                 create_timestamp = None, tags = None, attributes = None):
+                 create_timestamp = None, tags = None, attributes = None, filename = None):
         if not mime_type in Image.MIME_EXT_MAP:
             raise ValueError('Invalid Image mime_type: %s' % mime_type)
 
@@ -156,9 +215,14 @@ class Image:
         self.attributes = set(attributes or [])
         self.timestamp = timestamp or datetime.now()
         self.create_timestamp = create_timestamp
+        # Set when the image shares a stored original with another.
+        self.filename = filename
 
     def get_filename(self):
-        return self.id + Image.MIME_EXT_MAP[self.mime_type]
+        return self.filename or self.id + Image.MIME_EXT_MAP[self.mime_type]
+
+    def get_file_id(self):
+        return self.get_filename().rsplit('.', 1)[0]
 
     def can_view(self, user):
         return (user.has_right(UserRight.ADMIN) or
@@ -170,11 +234,21 @@ class Image:
                     user.get_tag() in self.tags) or (
                     User.ALL in self.tags)))
 
-    def add_tags(self, *args):
-        for arg in args:
-            self.tags.add(arg)
+    def has_thumbnail(self):
+        return not (Image.PROCESSING_TAG in self.tags or
+                    Image.PROCESSING_FAILED_TAG in self.tags)
 
-    def populate_from_metadata(self, metadata_map):
+    def add_tags(self, *args):
+        self.tags.update(normalize_tags(args))
+
+    def populate_from_metadata(self, metadata_map, date_tags = True):
+        """
+            Set the capture date from EXIF or file metadata, tagging
+            images whose date is missing or invalid.  The date is also
+            added as date:YYYY and date:MM-YYYY tags if date_tags is
+            set; the after: and before: search operators don't need
+            them.
+        """
         ts = None
 
         if 'exif:DateTime' in metadata_map:
@@ -196,7 +270,8 @@ class Image:
 
         if ts is not None:
             self.create_timestamp = ts
-            self.add_tags(
-                'date:%d' % ts.year,
-                'date:%02d-%d' % (ts.month, ts.year))
+            if date_tags:
+                self.add_tags(
+                    'date:%d' % ts.year,
+                    'date:%02d-%d' % (ts.month, ts.year))
 
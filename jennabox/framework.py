@@ -7,12 +7,17 @@
 #--------------------------------------------------------------------
 
 import cherrypy
+import collections
 import inspect
 import os
+import threading
+import time
 
 from xeno import inject
 
+from .cache import LRUCache
 from .markup import markup
+from .metrics import Timing
 
 #--------------------------------------------------------------------
 def before(f):
@@ -36,7 +41,7 @@ def render(f):
     def render_f(self, *args, **kwargs):
         renderer = f(self, *args, **kwargs)
         self.injector.inject(renderer)
-        return str(renderer.render())
+        return self.fragment_cache.render_page(renderer)
     if hasattr(f, 'exposed'):
         render_f.exposed = f.exposed
     return render_f
@@ -44,11 +49,12 @@ def render(f):
 #--------------------------------------------------------------------
 def server(cls):
     @inject
-    def inject_deps(self, injector, log, cherrypy_config, auth, dao_factory):
+    def inject_deps(self, injector, log, cherrypy_config, auth, dao_factory, fragment_cache):
         self.injector = injector
         self.cherrypy_config = cherrypy_config
         self.auth = auth
         self.dao_factory = dao_factory
+        self.fragment_cache = fragment_cache
         self.log = log
 
     cls._pre_handlers = []
@@ -149,6 +155,141 @@ class Renderer:
     def render(self):
         raise NotImplementedError()
 
+    def cache_key(self):
+        """
+            A key for everything the rendered markup depends on, or
+            None if the markup can't be cached.  Renderers of the same
+            class with equal keys must render identical markup.
+        """
+        return None
+
+#--------------------------------------------------------------------
+class RawHtml:
+    """
+        Serialized markup to be spliced into an indenti element tree.
+        Strings are escaped as text, but other children are rendered
+        with str() and indented to their place in the tree.
+    """
+
+    def __init__(self, markup):
+        self.markup = markup
+
+    def __str__(self):
+        return self.markup
+
+#--------------------------------------------------------------------
+class FragmentCache:
+    """
+        Caches the serialized markup of Renderers which have a
+        cache_key(), such as the header and asset tags which are the
+        same on most pages, so they are neither rebuilt nor serialized
+        again.  Also times each page's tree building, serialization
+        and fragments, for the 'render' metrics.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.cache = LRUCache(max_entries, max_bytes)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pages = collections.OrderedDict()
+
+    def render(self, renderer):
+        """
+            Render a fragment, returning cached markup if its key has
+            been seen before.
+        """
+        started = time.perf_counter()
+        key = renderer.cache_key()
+        if key is None:
+            result = renderer.render()
+        else:
+            key = (type(renderer).__name__, key)
+            result = self.cache.get(key)
+            if result is None:
+                result = RawHtml(self.serialize(renderer.render()))
+                self.cache.put(key, result, 64 + len(result.markup))
+
+        timings = getattr(self.local, 'timings', None)
+        if timings is not None:
+            timings.fragment(type(renderer).__name__).record(time.perf_counter() - started)
+        return result
+
+    def render_page(self, page):
+        timings = self._page_timings(type(page).__name__)
+        self.local.timings = timings
+        try:
+            started = time.perf_counter()
+            tree = page.render()
+            built = time.perf_counter()
+            markup = str(tree)
+            finished = time.perf_counter()
+        finally:
+            self.local.timings = None
+
+        timings.build.record(built - started)
+        timings.serialize.record(finished - built)
+        timings.total.record(finished - started)
+        return markup
+
+    def serialize(self, tree):
+        """
+            Serialize a fragment's element or list of elements the way
+            indenti would as children of another element, one line at
+            a time.
+        """
+        if isinstance(tree, (list, tuple)):
+            return ''.join(self.serialize(node) for node in tree)
+        markup = str(tree)
+        return markup if markup.endswith('\n') else markup + '\n'
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        with self.lock:
+            pages = list(self.pages.items())
+        return {
+            'cache':    self.cache.stats(),
+            'pages':    collections.OrderedDict((name, timings.stats()) for name, timings in pages)
+        }
+
+    def _page_timings(self, name):
+        with self.lock:
+            if name not in self.pages:
+                self.pages[name] = PageTimings()
+            return self.pages[name]
+
+#--------------------------------------------------------------------
+class PageTimings:
+    """
+        Where the time rendering one kind of page goes.  Fragment
+        times are part of the build time, and the rest of the build
+        time is mostly the page content.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = Timing()
+        self.build = Timing()
+        self.serialize = Timing()
+        self.fragments = collections.OrderedDict()
+
+    def fragment(self, name):
+        with self.lock:
+            if name not in self.fragments:
+                self.fragments[name] = Timing()
+            return self.fragments[name]
+
+    def stats(self):
+        with self.lock:
+            fragments = list(self.fragments.items())
+        return {
+            'total':        self.total.stats(),
+            'build':        self.build.stats(),
+            'serialize':    self.serialize.stats(),
+            'fragments':    collections.OrderedDict((name, timing.stats()) for name, timing in fragments)
+        }
+
 #--------------------------------------------------------------------
 class AssetList(Renderer):
     def __init__(self):
@@ -183,3 +324,6 @@ class AssetList(Renderer):
         return ([markup.js(js) for js in self._js_files] +
                 [markup.css(css) for css in self._css_files])
 
+    def cache_key(self):
+        return (tuple(self._js_files), tuple(self._css_files))
+
@@ -0,0 +1,318 @@
+#--------------------------------------------------------------------
+# JennaBox: A lightweight privacy-focused image tagging and
+#           sharing website.
+#
+# Author: Lain Supe (lainproliant)
+# Date: Tuesday, August 23rd 2016
+#--------------------------------------------------------------------
+
+import bisect
+import collections
+import threading
+
+from array import array
+
+from .domain import normalize_tag
+from .query import Cursor, DateRangeTerm, NotTerm, OrTerm, PrefixTerm, SortOrder, TagTerm, TextTerm, last_page_size
+
+#--------------------------------------------------------------------
+def mask(nbits):
+    return (1 << nbits) - 1
+
+#--------------------------------------------------------------------
+def select_bit(bitmap, rank):
+    """
+        Find the position of the set bit with the given rank, counting
+        from the least significant set bit.
+    """
+    lo, hi = 0, bitmap.bit_length()
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if (bitmap & mask(mid + 1)).bit_count() > rank:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+#--------------------------------------------------------------------
+class TagIndex:
+    """
+        An in-process inverted index from tags to images.
+
+        Each image is given a dense integer ordinal in search order
+        (ts ascending, then id descending).  Each tag maps to a posting
+        of ordinals: a sorted array of ordinals for most tags, or a
+        bitmap stored as a python int for tags on more than one in
+        DENSE_RATIO images, where the bitmap is the smaller of the two.
+        Searches expand postings to bitmaps and become bitwise AND/NOT
+        operations, and the first image of a search result is its
+        highest set bit.  Tags are also kept in sorted order, so that a
+        pattern only looks at the tags in its prefix's range.
+
+        The library generation, bumped by triggers on every change to
+        images and image_tags, is checked on each search.  Writes by
+        other processes, such as admin.py, make the index rebuild.
+    """
+
+    # Rebuild once this fraction of ordinals are holes left by deletes.
+    MAX_HOLE_RATIO = 0.25
+
+    # A bitmap costs one bit per image and an array four bytes per
+    # ordinal, so tags on more than 1/32 of images are kept as bitmaps.
+    DENSE_RATIO = 32
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        self.ids = []
+        self.timestamps = []
+        self.ordinals = {}
+        self.image_tags = {}
+        self.postings = {}
+        self.vocabulary = []
+        self.alive = 0
+        self.tail = None
+        self.generation = None
+        self.stale = True
+
+    def normalize(self, tag):
+        return normalize_tag(tag)
+
+    def rebuild(self, db):
+        with self.lock:
+            self.clear()
+            if not db.in_transaction:
+                # Read the generation, images and tags from one snapshot.
+                db.execute('begin')
+            c = db.cursor()
+            c.execute('select generation from library_state')
+            generation = c.fetchone()[0]
+            c.execute('select id, ts from images order by ts, id desc')
+            for id, ts in c:
+                self.ordinals[id] = len(self.ids)
+                self.ids.append(id)
+                self.timestamps.append(str(ts))
+                self.image_tags[id] = set()
+                self.tail = (str(ts), id)
+
+            postings = collections.defaultdict(list)
+            c.execute('select id, tag from image_tags')
+            for id, tag in c:
+                ordinal = self.ordinals.get(id)
+                if ordinal is None:
+                    continue
+                tag = self.normalize(tag)
+                image_tags = self.image_tags[id]
+                if tag not in image_tags:
+                    image_tags.add(tag)
+                    postings[tag].append(ordinal)
+
+            for tag, ordinals in postings.items():
+                ordinals.sort()
+                self.postings[tag] = self._bitmap(ordinals) if self._is_dense(len(ordinals)) else array('I', ordinals)
+            self.vocabulary = sorted(self.postings)
+            self.alive = mask(len(self.ids))
+            self.generation = generation
+            self.stale = False
+
+    def update(self, images, before, after):
+        """
+            Apply saved images to the index.  before and after are the
+            library generations around the write which saved them.
+        """
+        with self.lock:
+            if self._advance(before, after):
+                for image in images:
+                    self._update(image)
+
+    def remove(self, image_id, before, after):
+        with self.lock:
+            if self._advance(before, after):
+                self._remove(image_id)
+
+    def _advance(self, before, after):
+        if self.stale:
+            return False
+        if self.generation != before:
+            # Something else wrote to the library since the index was
+            # last in step with it.
+            self.stale = True
+            return False
+        self.generation = after
+        return True
+
+    def _update(self, image):
+        if self.stale:
+            return
+
+        tags = set(self.normalize(tag) for tag in image.tags)
+        ts = str(image.timestamp)
+        ordinal = self.ordinals.get(image.id)
+
+        if ordinal is not None and self.timestamps[ordinal] != ts:
+            self._remove(image.id)
+            ordinal = None
+            if self.stale:
+                return
+
+        if ordinal is None:
+            if self.tail is not None and (ts < self.tail[0] or (
+                    ts == self.tail[0] and image.id > self.tail[1])):
+                # Ordinals must stay in search order, so an image
+                # saved with an older timestamp forces a rebuild.
+                self.stale = True
+                return
+            ordinal = len(self.ids)
+            self.ids.append(image.id)
+            self.timestamps.append(ts)
+            self.ordinals[image.id] = ordinal
+            self.image_tags[image.id] = set()
+            self.tail = (ts, image.id)
+            self.alive |= 1 << ordinal
+
+        old_tags = self.image_tags[image.id]
+        for tag in old_tags - tags:
+            self._discard(tag, ordinal)
+        for tag in tags - old_tags:
+            self._add(tag, ordinal)
+        self.image_tags[image.id] = tags
+
+    def _remove(self, image_id):
+        if self.stale or image_id not in self.ordinals:
+            return
+
+        ordinal = self.ordinals.pop(image_id)
+        for tag in self.image_tags.pop(image_id):
+            self._discard(tag, ordinal)
+        self.alive &= ~(1 << ordinal)
+        self.ids[ordinal] = None
+
+        if len(self.ids) - len(self.ordinals) > len(self.ids) * TagIndex.MAX_HOLE_RATIO:
+            self.stale = True
+
+    def _add(self, tag, ordinal):
+        posting = self.postings.get(tag)
+        if posting is None:
+            self.postings[tag] = array('I', [ordinal])
+            bisect.insort(self.vocabulary, tag)
+        elif type(posting) is int:
+            self.postings[tag] = posting | (1 << ordinal)
+        else:
+            n = bisect.bisect_left(posting, ordinal)
+            if n == len(posting) or posting[n] != ordinal:
+                posting.insert(n, ordinal)
+            if self._is_dense(len(posting)):
+                self.postings[tag] = self._bitmap(posting)
+
+    def _discard(self, tag, ordinal):
+        posting = self.postings.get(tag)
+        if posting is None:
+            return
+        if type(posting) is int:
+            posting &= ~(1 << ordinal)
+            self.postings[tag] = posting
+        else:
+            n = bisect.bisect_left(posting, ordinal)
+            if n < len(posting) and posting[n] == ordinal:
+                del posting[n]
+        if not posting:
+            del self.postings[tag]
+            del self.vocabulary[bisect.bisect_left(self.vocabulary, tag)]
+
+    def _is_dense(self, count):
+        return count * TagIndex.DENSE_RATIO > len(self.ids)
+
+    def evaluate(self, query):
+        """
+            The bitmap of images matching a parsed query.
+        """
+        if type(query) is TagTerm:
+            return self._posting_bitmap(self.postings.get(query.tag))
+        elif type(query) is PrefixTerm:
+            start, end = 0, len(self.vocabulary)
+            if query.prefix:
+                start = bisect.bisect_left(self.vocabulary, query.prefix)
+                end = bisect.bisect_left(self.vocabulary, query.upper, start)
+            result = 0
+            for tag in self.vocabulary[start:end]:
+                if query.matches(tag):
+                    result |= self._posting_bitmap(self.postings[tag])
+            return result
+        elif type(query) is NotTerm:
+            return self.alive & ~self.evaluate(query.child)
+        elif type(query) is OrTerm:
+            result = 0
+            for child in query.children:
+                result |= self.evaluate(child)
+            return result
+        else:
+            result = self.alive
+            for child in query.children:
+                result &= self.evaluate(child)
+            return result
+
+    def find(self, db, query, limit, offset, cursor = None, sort = SortOrder.UPLOADED):
+        """
+            Find a page of image ids, newest first, along with the
+            total number of images matching the query.  Returns None if
+            the cursor refers to an image the index can't place, or if
+            the index can't answer the query: it only orders by upload
+            time and doesn't hold capture dates or summaries.
+        """
+        if sort != SortOrder.UPLOADED or any(type(term) in (DateRangeTerm, TextTerm) for term in query.terms()):
+            return None
+
+        with self.lock:
+            if self.stale or db.execute('select generation from library_state').fetchone()[0] != self.generation:
+                self.rebuild(db)
+
+            result = self.evaluate(query)
+            count = result.bit_count()
+
+            if cursor is None:
+                return self._page(result, count, limit, max(offset, 0)), count
+
+            if cursor.direction == Cursor.LAST:
+                size = last_page_size(count, limit)
+                return self._page(result, count, size, count - size), count
+
+            ordinal = self.ordinals.get(cursor.id)
+            if ordinal is None or self.timestamps[ordinal] != cursor.ts:
+                return None
+
+            if cursor.direction == Cursor.AFTER:
+                region = result & mask(ordinal)
+                return self._page(region, region.bit_count(), limit, cursor.skip), count
+            else:
+                region = result & ~mask(ordinal + 1)
+                n = region.bit_count()
+                size = min(limit, n - cursor.skip)
+                return self._page(region, n, size, n - cursor.skip - size), count
+
+    def _page(self, bitmap, count, limit, offset):
+        if limit <= 0 or offset >= count:
+            return []
+
+        top = select_bit(bitmap, count - 1 - offset)
+        bitmap &= mask(top + 1)
+        page = []
+        while bitmap and len(page) < limit:
+            ordinal = bitmap.bit_length() - 1
+            page.append(self.ids[ordinal])
+            bitmap ^= 1 << ordinal
+        return page
+
+    def _posting_bitmap(self, posting):
+        if posting is None:
+            return 0
+        if type(posting) is int:
+            return posting
+        return self._bitmap(posting)
+
+    def _bitmap(self, ordinals):
+        data = bytearray((len(self.ids) + 7) // 8)
+        for ordinal in ordinals:
+            data[ordinal >> 3] |= 1 << (ordinal & 7)
+        return int.from_bytes(data, 'little')
@@ -0,0 +1,423 @@
+#--------------------------------------------------------------------
+# JennaBox: A lightweight privacy-focused image tagging and
+#           sharing website.
+#
+# Author: Lain Supe (lainproliant)
+# Date: Tuesday, August 23rd 2016
+#--------------------------------------------------------------------
+
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+import traceback
+import wand.image
+import wand.resource
+
+from concurrent.futures.process import BrokenProcessPool
+from .domain import Image
+from .metrics import Timing
+
+#--------------------------------------------------------------------
+class IngestResult:
+    """
+        Everything learned about an image from decoding it once.
+    """
+
+    def __init__(self, metadata_map, width, height, byte_size, frames = 1, error = None):
+        self.metadata_map = metadata_map
+        self.width = width
+        self.height = height
+        self.byte_size = byte_size
+        self.frames = frames
+        self.error = error
+        self.webp = False
+        self.started = None
+        self.elapsed = None
+        self.cpu_time = None
+        self.output_bytes = 0
+
+    def is_animated(self):
+        return self.frames > 1
+
+    def get_metadata(self):
+        """
+            The metadata map to persist, including the pixel dimensions
+            and byte size under the 'jennabox:' namespace.
+        """
+        metadata_map = dict(self.metadata_map)
+        metadata_map[Image.WIDTH_KEY] = str(self.width)
+        metadata_map[Image.HEIGHT_KEY] = str(self.height)
+        metadata_map[Image.BYTE_SIZE_KEY] = str(self.byte_size)
+        metadata_map[Image.FRAMES_KEY] = str(self.frames)
+        if self.webp:
+            metadata_map[Image.WEBP_KEY] = '1'
+        return metadata_map
+
+#--------------------------------------------------------------------
+# ImageMagick resource limits for ingest.  Each pool worker is its own
+# process, so ImageMagick's own threading is disabled.
+DEFAULT_RESOURCE_LIMITS = {
+    'memory':   256 * 1024 * 1024,
+    'map':      512 * 1024 * 1024,
+    'area':     64 * 1000 * 1000,
+    'thread':   1
+}
+
+#--------------------------------------------------------------------
+def apply_resource_limits(limits):
+    for name, value in limits.items():
+        wand.resource.limits[name] = value
+
+#--------------------------------------------------------------------
+def hash_file(filename, chunk_size = 65536):
+    """
+        The SHA-256 hex digest of a file, used to identify duplicate
+        originals.
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as infile:
+        while True:
+            data = infile.read(chunk_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+#--------------------------------------------------------------------
+def output_size(filename):
+    if filename is not None and os.path.exists(filename):
+        return os.path.getsize(filename)
+    return 0
+
+#--------------------------------------------------------------------
+def write_animated_preview(image_filename, preview_filename):
+    """
+        Write a small animated preview from at most the first
+        Image.PREVIEW_MAX_FRAMES frames of an animation.
+    """
+    with wand.image.Image(filename = '%s[0-%d]' % (image_filename, Image.PREVIEW_MAX_FRAMES - 1)) as wand_image:
+        wand_image.coalesce()
+        wand_image.transform(resize = Image.THUMB_RESIZE_TRANSFORM)
+        wand_image.optimize_layers()
+        wand_image.save(filename = preview_filename)
+
+#--------------------------------------------------------------------
+def write_webp(image_filename, webp_filename):
+    """
+        Losslessly convert an animation to WebP, keeping the result
+        only if it is smaller than the original.
+    """
+    with wand.image.Image(filename = image_filename) as wand_image:
+        wand_image.coalesce()
+        wand_image.format = 'webp'
+        wand_image.options['webp:lossless'] = 'true'
+        wand_image.save(filename = webp_filename)
+
+    if os.path.getsize(webp_filename) >= os.path.getsize(image_filename):
+        os.remove(webp_filename)
+        return False
+    return True
+
+#--------------------------------------------------------------------
+def ingest_image(image_filename, mini_filename = None, decode_size = Image.THUMB_DECODE_SIZE,
+                 preview_filename = None, webp_filename = None):
+    """
+        Decode an image once, reading its metadata and dimensions and,
+        if a mini_filename is given, writing its thumbnail.  Runs in an
+        ingest pool worker process for uploads.
+
+        The original dimensions come from a header-only ping, so JPEGs
+        can be decoded at a reduced scale no smaller than decode_size.
+        Only the first frame of an animation is decoded for the
+        thumbnail; the animated preview and WebP conversion are written
+        separately when their filenames are given.
+    """
+    started = time.time()
+    cpu_started = time.process_time()
+    metadata_map = {}
+    error = None
+
+    with wand.image.Image.ping(filename = image_filename) as probe:
+        width, height = probe.width, probe.height
+        frames = len(probe.sequence)
+
+    with wand.image.Image() as wand_image:
+        if decode_size is not None:
+            wand_image.options['jpeg:size'] = decode_size
+        if frames > 1:
+            wand_image.read(filename = image_filename + '[0]')
+        else:
+            wand_image.read(filename = image_filename)
+
+        try:
+            for key, value in wand_image.metadata.items():
+                metadata_map[key] = value
+        except Exception:
+            error = traceback.format_exc()
+
+        if mini_filename is not None:
+            wand_image.transform(resize = Image.THUMB_RESIZE_TRANSFORM)
+            wand_image.save(filename = mini_filename)
+
+    result = IngestResult(metadata_map, width, height,
+                          os.path.getsize(image_filename), frames, error)
+    result.output_bytes = output_size(mini_filename)
+
+    if result.is_animated():
+        if preview_filename is not None:
+            write_animated_preview(image_filename, preview_filename)
+            result.output_bytes += output_size(preview_filename)
+        if webp_filename is not None:
+            result.webp = write_webp(image_filename, webp_filename)
+            result.output_bytes += output_size(webp_filename)
+
+    result.started = started
+    result.elapsed = time.time() - started
+    result.cpu_time = time.process_time() - cpu_started
+    return result
+
+#--------------------------------------------------------------------
+def import_image(source_filename, image_filename, mini_filename = None,
+                 preview_filename = None, webp_filename = None):
+    """
+        Copy an original from outside of the image directory and ingest
+        it.  Runs in a worker process for bulk imports.
+    """
+    shutil.copyfile(source_filename, image_filename)
+    return ingest_image(image_filename, mini_filename,
+                        preview_filename = preview_filename,
+                        webp_filename = webp_filename)
+
+#--------------------------------------------------------------------
+class IngestJob:
+    """
+        An image being processed by the ingest pool.  A job is finished
+        exactly once, either by its result or by timing out.
+    """
+
+    # Times a job is resubmitted after its pool was replaced under it.
+    MAX_RETRIES = 1
+
+    def __init__(self, image, *args, **kwargs):
+        self.image = image
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted = time.time()
+        self.lock = threading.Lock()
+        self.finished = False
+        self.retries = 0
+        self.executor = None
+        self.timer = None
+
+    def claim(self):
+        with self.lock:
+            if self.finished:
+                return False
+            self.finished = True
+            return True
+
+    def retry(self):
+        with self.lock:
+            if self.finished or self.retries >= IngestJob.MAX_RETRIES:
+                return False
+            self.retries += 1
+            return True
+
+#--------------------------------------------------------------------
+class IngestPool:
+    """
+        A bounded process pool which generates thumbnails and metadata
+        for uploaded images off of the request threads.  When a job is
+        done the image row is updated through the image DAO.
+
+        If a worker dies, for example killed for running out of memory,
+        the pool is replaced.  A job which takes longer than job_timeout
+        seconds is given up on, and the pool is replaced with its worker
+        processes killed, so that the stuck worker no longer holds a
+        slot.  Other jobs lost with a replaced pool are resubmitted once.
+    """
+
+    def __init__(self, log, dao_factory, max_workers, max_queue, job_timeout, resource_limits):
+        self.log = log
+        self.dao_factory = dao_factory
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.job_timeout = job_timeout
+        self.resource_limits = resource_limits
+        self.executor = self._create_executor()
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.restarts = 0
+        self.wait_timing = Timing()
+        self.job_timing = Timing()
+        self.cpu_timing = Timing()
+        self.animated_cpu_timing = Timing()
+        self.output_bytes = 0
+        self.animated_output_bytes = 0
+
+    def submit(self, image, image_filename, mini_filename, preview_filename = None,
+               webp_filename = None):
+        """
+            Queue an image for processing.  Returns False without
+            queueing anything if the pool is already at capacity, or
+            is broken and couldn't be replaced.
+        """
+        with self.lock:
+            if self.pending >= self.max_queue:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            self.submitted += 1
+
+        job = IngestJob(image, image_filename, mini_filename,
+                        preview_filename = preview_filename,
+                        webp_filename = webp_filename)
+        try:
+            self._start(job)
+        except BrokenProcessPool:
+            self.log.exception('Ingest pool is still broken, image %s will be processed inline.' % image.id)
+            with self.lock:
+                self.pending -= 1
+                self.submitted -= 1
+            return False
+        return True
+
+    def _start(self, job):
+        job.executor, future = self._submit(ingest_image, *job.args, **job.kwargs)
+        job.timer = threading.Timer(self.job_timeout, self._expire, (job, future))
+        job.timer.daemon = True
+        job.timer.start()
+        future.add_done_callback(lambda f: self._finish(job, f))
+
+    def _submit(self, fn, *args, **kwargs):
+        """
+            Submit to the executor, replacing it once if it is broken.
+            Returns the executor used and the future.
+        """
+        executor = self.executor
+        try:
+            return executor, executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            self.log.error('Ingest pool is broken, a worker may have been killed.  Starting a new pool.')
+            self._replace_executor(executor)
+            executor = self.executor
+            return executor, executor.submit(fn, *args, **kwargs)
+
+    def _create_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            self.max_workers, mp_context = multiprocessing.get_context('spawn'),
+            initializer = apply_resource_limits, initargs = (self.resource_limits,))
+
+    def _replace_executor(self, executor):
+        with self.lock:
+            if self.executor is not executor:
+                # Another thread already replaced it.
+                return
+            self.executor = self._create_executor()
+            self.restarts += 1
+        # shutdown() doesn't stop running workers, so they are killed.
+        # Their jobs and those still queued fail or are cancelled, and
+        # are resubmitted to the new pool by _finish().
+        processes = list((executor._processes or {}).values())
+        executor.shutdown(wait = False, cancel_futures = True)
+        for process in processes:
+            process.terminate()
+
+    def _expire(self, job, future):
+        if not job.claim():
+            return
+        self.log.error('Image %s was not processed within %d seconds, giving up.' % (
+            job.image.id, self.job_timeout))
+        self._replace_executor(job.executor)
+        with self.lock:
+            self.failed += 1
+            self.timed_out += 1
+            self.pending -= 1
+        try:
+            self.dao_factory.get_image_dao().fail_processing(job.image)
+        except Exception:
+            self.log.exception('Failed to flag image %s as failed.' % job.image.id)
+
+    def _finish(self, job, future):
+        if self._lost(job, future) and job.retry():
+            job.timer.cancel()
+            self.log.warn('Resubmitting image %s, its ingest pool was replaced.' % job.image.id)
+            try:
+                self._start(job)
+                return
+            except BrokenProcessPool:
+                self.log.exception('Ingest pool is still broken, image %s could not be resubmitted.' % job.image.id)
+
+        if not job.claim():
+            # The job timed out and was already flagged as failed.
+            return
+        job.timer.cancel()
+        image = job.image
+        try:
+            result = future.result()
+            self.wait_timing.record(max(result.started - job.submitted, 0.0))
+            self.job_timing.record(result.elapsed)
+            self.cpu_timing.record(result.cpu_time)
+            if result.is_animated():
+                self.animated_cpu_timing.record(result.cpu_time)
+            self.dao_factory.get_image_dao().finish_processing(image, result)
+            with self.lock:
+                self.completed += 1
+                self.output_bytes += result.output_bytes
+                if result.is_animated():
+                    self.animated_output_bytes += result.output_bytes
+
+        except Exception:
+            self.log.exception('Failed to process image %s.' % image.id)
+            with self.lock:
+                self.failed += 1
+            try:
+                self.dao_factory.get_image_dao().fail_processing(image)
+            except Exception:
+                self.log.exception('Failed to flag image %s as failed.' % image.id)
+
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def _lost(self, job, future):
+        """
+            Whether the job failed only because its pool was replaced.
+        """
+        if job.executor is self.executor:
+            return False
+        return future.cancelled() or isinstance(future.exception(), BrokenProcessPool)
+
+    def shutdown(self):
+        self.executor.shutdown(wait = True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers':      self.max_workers,
+                'max_queue':    self.max_queue,
+                'queue_depth':  self.pending,
+                'submitted':    self.submitted,
+                'completed':    self.completed,
+                'failed':       self.failed,
+                'rejected':     self.rejected,
+                'timed_out':    self.timed_out,
+                'restarts':     self.restarts,
+                'queue_wait':   self.wait_timing.stats(),
+                'job':          self.job_timing.stats(),
+                'cpu':          self.cpu_timing.stats(),
+                'output_bytes': self.output_bytes,
+                'animated': {
+                    'cpu':          self.animated_cpu_timing.stats(),
+                    'output_bytes': self.animated_output_bytes
+                }
+            }
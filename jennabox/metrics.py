@@ -0,0 +1,59 @@
+#--------------------------------------------------------------------
+# JennaBox: A lightweight privacy-focused image tagging and
+#           sharing website.
+#
+# Author: Lain Supe (lainproliant)
+# Date: Tuesday, August 23rd 2016
+#--------------------------------------------------------------------
+
+import collections
+import threading
+
+#--------------------------------------------------------------------
+class Metrics:
+    """
+        A registry of named statistics sources.  Each source is a
+        callable returning a dict, sampled when a snapshot is taken.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sources = collections.OrderedDict()
+
+    def register(self, name, source):
+        with self.lock:
+            self.sources[name] = source
+
+    def snapshot(self):
+        with self.lock:
+            sources = list(self.sources.items())
+        return collections.OrderedDict((name, source()) for name, source in sources)
+
+#--------------------------------------------------------------------
+class Timing:
+    """
+        Accumulates durations, in seconds, for reporting as metrics.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            self.last = seconds
+
+    def stats(self):
+        with self.lock:
+            return {
+                'count':    self.count,
+                'avg_ms':   1000 * self.total / self.count if self.count else 0.0,
+                'max_ms':   1000 * self.max,
+                'last_ms':  1000 * self.last
+            }
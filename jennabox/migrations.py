@@ -0,0 +1,376 @@
+#--------------------------------------------------------------------
+# JennaBox: A lightweight privacy-focused image tagging and
+#           sharing website.
+#
+# Author: Lain Supe (lainproliant)
+# Date: Tuesday, August 23rd 2016
+#--------------------------------------------------------------------
+
+import collections
+import time
+
+from .domain import normalize_tag, user_tag
+
+#--------------------------------------------------------------------
+class MigrationError(Exception):
+    pass
+
+#--------------------------------------------------------------------
+class Migration:
+    """
+        One step in the evolution of the JennaBox schema.  Each step is
+        a list of SQL statements and python callables taking the
+        connection, which are run in order in a single transaction.
+    """
+
+    def __init__(self, version, description, *steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+    def apply(self, db):
+        for step in self.steps:
+            if callable(step):
+                step(db)
+            else:
+                db.execute(step)
+
+#--------------------------------------------------------------------
+def rebuild_table(table, ddl, columns):
+    """
+        A migration step which recreates a table from new DDL, copying
+        over the given columns.  SQLite can't alter constraints or turn
+        a table into a WITHOUT ROWID table in place.
+    """
+    def rebuild(db):
+        db.execute(ddl.format(table = table + '_new'))
+        db.execute('insert or ignore into {table}_new ({columns}) select {columns} from {table}'.format(
+            table = table, columns = columns))
+        db.execute('drop table {table}'.format(table = table))
+        db.execute('alter table {table}_new rename to {table}'.format(table = table))
+    return rebuild
+
+#--------------------------------------------------------------------
+def delete_orphans(db):
+    """
+        Delete rows left behind by deletes made before foreign keys were
+        enforced, such as the tags of images deleted by older versions.
+    """
+    db.execute('delete from image_tags where id not in (select id from images)')
+    db.execute('delete from user_rights where username not in (select username from users)')
+    db.execute('delete from user_attributes where username not in (select username from users)')
+
+#--------------------------------------------------------------------
+def normalize_stored_tags(db):
+    """
+        Rewrite tags to their normalized form, merging tags which only
+        differed by case, whitespace or Unicode composition.
+    """
+    tags = [row[0] for row in db.execute('select distinct tag from image_tags')]
+    for tag in tags:
+        normalized = normalize_tag(tag)
+        if normalized == tag:
+            continue
+        if normalized:
+            db.execute('insert or ignore into image_tags (id, tag) select id, ? from image_tags where tag = ?',
+                       (normalized, tag))
+        db.execute('delete from image_tags where tag = ?', (tag,))
+
+#--------------------------------------------------------------------
+def check_username_collisions(db):
+    """
+        Refuse to migrate while usernames differ only by case, as the
+        users would share a user: tag and see each other's images.
+    """
+    users = collections.defaultdict(list)
+    for (username,) in db.execute('select username from users order by username'):
+        users[user_tag(username)].append(username)
+    collisions = [usernames for usernames in users.values() if len(usernames) > 1]
+    if collisions:
+        raise MigrationError('Usernames must differ by more than case, rename or delete all but one of: %s' % (
+            '; '.join(', '.join(usernames) for usernames in collisions)))
+
+#--------------------------------------------------------------------
+def store_user_tags(db):
+    db.executemany('update users set user_tag = ? where username = ?',
+                   [(user_tag(username), username) for (username,) in db.execute('select username from users')])
+
+#--------------------------------------------------------------------
+MIGRATIONS = [
+    Migration(1, 'Initial schema',
+        '''create table users (
+           username          text primary key not null,
+           passhash          text not null
+        )''',
+        '''create table user_rights (
+           username          text not null,
+           app_right         text not null,
+           foreign key (username) references users(username)
+        )''',
+        '''create table user_attributes (
+           username          text not null,
+           attribute         text not null,
+           foreign key (username) references users(username)
+        )''',
+        '''create table images (
+           id                text primary key not null,
+           mime_type         text not null,
+           summary           text default '',
+           ts                timestamp not null,
+           create_ts         timestamp default null
+        )''',
+        '''create table image_tags (
+           id                text not null,
+           tag               text not null,
+           foreign key (id) references images(id)
+        )''',
+        'create index image_id_idx on image_tags(id)',
+        'create index image_tag_idx on image_tags (tag)'),
+
+    # image_metadata, blobs, image_blobs and checkpoints were first
+    # added to jennabox-ddl.sql alone, with no upgrade path.  Databases
+    # created from any version of that file are at version 1 and may
+    # have any of these already, so versions 2-4 are idempotent.
+    Migration(2, 'Stored image metadata and the search order index',
+        'create index if not exists image_ts_idx on images (ts desc, id)',
+        '''create table if not exists image_metadata (
+           id                text not null,
+           key               text not null,
+           value             text,
+           primary key (id, key),
+           foreign key (id) references images(id)
+        )'''),
+
+    Migration(3, 'Content addressed originals',
+        '''create table if not exists blobs (
+           hash              text primary key not null,
+           filename          text not null,
+           refcount          integer not null default 0
+        )''',
+        'create index if not exists blob_filename_idx on blobs (filename)',
+        '''create table if not exists image_blobs (
+           id                text primary key not null,
+           hash              text not null,
+           foreign key (id) references images(id),
+           foreign key (hash) references blobs(hash)
+        )''',
+        'create index if not exists image_blob_hash_idx on image_blobs (hash)'),
+
+    Migration(4, 'Admin command checkpoints',
+        '''create table if not exists checkpoints (
+           name              text primary key not null,
+           value             text
+        )'''),
+
+    Migration(5, 'Clustered image tags, timestamp indexes and cascading deletes',
+        delete_orphans,
+        'drop index if exists image_id_idx',
+        'drop index if exists image_tag_idx',
+        rebuild_table('image_tags', '''create table {table} (
+           id                text not null,
+           tag               text not null,
+           primary key (tag, id),
+           foreign key (id) references images(id) on delete cascade
+        ) without rowid''', 'id, tag'),
+        'create index image_tag_id_idx on image_tags (id, tag)',
+        'create index if not exists image_create_ts_idx on images (create_ts)',
+        rebuild_table('image_metadata', '''create table {table} (
+           id                text not null,
+           key               text not null,
+           value             text,
+           primary key (id, key),
+           foreign key (id) references images(id) on delete cascade deferrable initially deferred
+        ) without rowid''', 'id, key, value'),
+        rebuild_table('image_blobs', '''create table {table} (
+           id                text primary key not null,
+           hash              text not null,
+           foreign key (id) references images(id) on delete cascade deferrable initially deferred,
+           foreign key (hash) references blobs(hash)
+        ) without rowid''', 'id, hash'),
+        'create index image_blob_hash_idx on image_blobs (hash)',
+        rebuild_table('user_rights', '''create table {table} (
+           username          text not null,
+           app_right         text not null,
+           primary key (username, app_right),
+           foreign key (username) references users(username) on delete cascade
+        ) without rowid''', 'username, app_right'),
+        rebuild_table('user_attributes', '''create table {table} (
+           username          text not null,
+           attribute         text not null,
+           primary key (username, attribute),
+           foreign key (username) references users(username) on delete cascade
+        ) without rowid''', 'username, attribute'),
+        'analyze'),
+
+    Migration(6, 'Normalized tags',
+        check_username_collisions,
+        normalize_stored_tags),
+
+    Migration(7, 'Tag statistics',
+        '''create table tag_stats (
+           tag               text primary key not null,
+           image_count       integer not null
+        ) without rowid''',
+        'insert into tag_stats (tag, image_count) select tag, count(*) from image_tags group by tag',
+        '''create trigger image_tag_insert_stats after insert on image_tags begin
+           insert into tag_stats (tag, image_count) values (new.tag, 1)
+              on conflict(tag) do update set image_count = image_count + 1;
+        end''',
+        '''create trigger image_tag_delete_stats after delete on image_tags begin
+           update tag_stats set image_count = image_count - 1 where tag = old.tag;
+           delete from tag_stats where tag = old.tag and image_count <= 0;
+        end'''),
+
+    Migration(8, 'Capture date sort order index',
+        'create index image_taken_idx on images (coalesce(create_ts, ts) desc, id)'),
+
+    # The text index reads summaries from the images table, and is kept
+    # in step with it by triggers.  'rebuild' indexes existing images.
+    Migration(9, 'Full-text index of image summaries',
+        '''create virtual table image_text using fts5 (
+           summary,
+           content = 'images',
+           content_rowid = 'rowid',
+           tokenize = 'unicode61 remove_diacritics 2'
+        )''',
+        '''create trigger image_text_insert after insert on images begin
+           insert into image_text (rowid, summary) values (new.rowid, new.summary);
+        end''',
+        '''create trigger image_text_delete after delete on images begin
+           insert into image_text (image_text, rowid, summary) values ('delete', old.rowid, old.summary);
+        end''',
+        '''create trigger image_text_update after update of summary on images
+           when old.summary is not new.summary begin
+           insert into image_text (image_text, rowid, summary) values ('delete', old.rowid, old.summary);
+           insert into image_text (rowid, summary) values (new.rowid, new.summary);
+        end''',
+        "insert into image_text (image_text) values ('rebuild')"),
+
+    Migration(10, 'Persistent logins',
+        '''create table logins (
+           token             text primary key not null,
+           username          text not null,
+           expiry_ts         timestamp not null,
+           foreign key (username) references users(username) on delete cascade
+        ) without rowid''',
+        'create index login_expiry_idx on logins (expiry_ts)',
+        'create index login_username_idx on logins (username)'),
+
+    Migration(11, 'Login generations for revoking signed login tokens',
+        'alter table users add column login_generation integer not null default 0'),
+
+    # Bumped by every change to images and their tags, including those
+    # made by other processes, so that the tag index can tell when it
+    # is out of date.
+    Migration(12, 'Library generation',
+        '''create table library_state (
+           id                integer primary key check (id = 0),
+           generation        integer not null
+        )''',
+        'insert into library_state (id, generation) values (0, 0)',
+        *[('create trigger library_{table}_{event} after {event} on {table} begin '
+           'update library_state set generation = generation + 1; end').format(table = table, event = event)
+          for table in ('images', 'image_tags') for event in ('insert', 'update', 'delete')]),
+
+    # Databases which passed migration 6 before it checked usernames
+    # are checked again here.
+    Migration(13, 'Case insensitive usernames',
+        check_username_collisions,
+        'alter table users add column user_tag text',
+        store_user_tags,
+        'create unique index user_tag_idx on users (user_tag)'),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+#--------------------------------------------------------------------
+def ensure_version_table(db):
+    db.execute('''create table if not exists schema_version (
+       version           integer primary key not null,
+       description       text not null,
+       applied_ts        timestamp not null
+    )''')
+
+#--------------------------------------------------------------------
+def current_version(db):
+    """
+        The schema version of the database, 0 for an empty database.
+        Databases created before migrations existed are at version 1.
+    """
+    c = db.cursor()
+    c.execute("select name from sqlite_master where type = 'table' and name in ('schema_version', 'images')")
+    tables = set(row[0] for row in c.fetchall())
+    if 'schema_version' in tables:
+        c.execute('select max(version) from schema_version')
+        version = c.fetchone()[0]
+        if version is not None:
+            return version
+    return 1 if 'images' in tables else 0
+
+#--------------------------------------------------------------------
+def foreign_key_violations(db):
+    """
+        Count foreign key violations by table and referenced table.
+    """
+    return collections.Counter((row[0], row[2]) for row in db.execute('pragma foreign_key_check'))
+
+#--------------------------------------------------------------------
+def migrate(db, target = None, log = None):
+    """
+        Bring the database up to the target version, or the latest if
+        none is given, returning the migrations which were applied.
+        Each migration runs in its own transaction with foreign keys
+        checked at the end.  Violations which were already there before
+        migrating, such as orphans from before foreign keys were
+        enforced, are logged rather than failing the migration.
+    """
+    target = LATEST_VERSION if target is None else target
+    isolation_level = db.isolation_level
+    foreign_keys = db.execute('pragma foreign_keys').fetchone()[0]
+    db.isolation_level = None
+    db.execute('pragma foreign_keys = off')
+
+    try:
+        version = current_version(db)
+        ensure_version_table(db)
+        if version == 1:
+            # Record the implicit baseline of a pre-migration database.
+            db.execute('insert or ignore into schema_version (version, description, applied_ts) values (?, ?, ?)',
+                       (1, MIGRATIONS[0].description, time.strftime('%Y-%m-%d %H:%M:%S')))
+
+        applied = []
+        violations = collections.Counter()
+        if any(migration.version > version and migration.version <= target for migration in MIGRATIONS):
+            violations = foreign_key_violations(db)
+            if violations and log is not None:
+                log.warn('Database has %d foreign key violations before migrating: %s' % (
+                    sum(violations.values()), ', '.join('%s -> %s' % key for key in violations)))
+
+        for migration in MIGRATIONS:
+            if migration.version <= version or migration.version > target:
+                continue
+
+            if log is not None:
+                log.info('Applying migration %d: %s' % (migration.version, migration.description))
+            db.execute('begin immediate')
+            try:
+                migration.apply(db)
+                after = foreign_key_violations(db)
+                new_violations = after - violations
+                if new_violations:
+                    raise MigrationError('Migration %d left %d new foreign key violations, e.g. %s -> %s.' % (
+                        migration.version, sum(new_violations.values()), *next(iter(new_violations))))
+                db.execute('insert into schema_version (version, description, applied_ts) values (?, ?, ?)',
+                           (migration.version, migration.description, time.strftime('%Y-%m-%d %H:%M:%S')))
+                db.execute('commit')
+            except Exception:
+                db.execute('rollback')
+                raise
+            violations = after
+            applied.append(migration)
+
+        return applied
+
+    finally:
+        db.execute('pragma foreign_keys = %s' % ('on' if foreign_keys else 'off'))
+        db.isolation_level = isolation_level
@@ -0,0 +1,647 @@
+#--------------------------------------------------------------------
+# JennaBox: A lightweight privacy-focused image tagging and
+#           sharing website.
+#
+# Author: Lain Supe (lainproliant)
+# Date: Tuesday, August 23rd 2016
+#--------------------------------------------------------------------
+
+import base64
+import datetime
+import functools
+import json
+import re
+
+from .domain import normalize_tag, normalize_tags
+
+#--------------------------------------------------------------------
+def last_page_size(count, page_size):
+    if count <= 0:
+        return 0
+    return count - page_size * ((count - 1) // page_size)
+
+#--------------------------------------------------------------------
+class Cursor:
+    """
+        An opaque position in a search result, used for keyset
+        pagination over (ts, id).  'after' pages start just past the
+        image at (ts, id) going back in time, 'before' pages end just
+        before it, and 'last' is the oldest page of results.  'skip'
+        lets page links jump a few pages from the cursor.
+    """
+
+    AFTER = 'after'
+    BEFORE = 'before'
+    LAST = 'last'
+
+    def __init__(self, page, direction, ts = None, id = None, skip = 0):
+        self.page = page
+        self.direction = direction
+        self.ts = ts
+        self.id = id
+        self.skip = skip
+
+    def encode(self):
+        data = json.dumps([self.page, self.direction, self.ts, self.id, self.skip])
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode(token):
+        try:
+            page, direction, ts, id, skip = json.loads(
+                base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        except Exception as e:
+            raise ValueError('Invalid cursor: %s' % token) from e
+
+        # Cursors come from URLs, so every field is checked before use.
+        if not isinstance(direction, str) or direction not in (Cursor.AFTER, Cursor.BEFORE, Cursor.LAST):
+            raise ValueError('Invalid cursor direction: %s' % token)
+        if not all(type(n) is int for n in (page, skip)):
+            raise ValueError('Invalid cursor page: %s' % token)
+        if not all(value is None or isinstance(value, str) for value in (ts, id)):
+            raise ValueError('Invalid cursor position: %s' % token)
+        if direction != Cursor.LAST and (ts is None or id is None):
+            raise ValueError('Cursor is missing its position: %s' % token)
+
+        return Cursor(page, direction, ts, id, max(skip, 0))
+
+#--------------------------------------------------------------------
+class SortOrder:
+    """
+        Search results are ordered newest first, either by when images
+        were uploaded or by when they were taken.  Images without a
+        capture date sort by their upload time.  Searches for summary
+        text may instead be ordered by how well each summary matches,
+        and otherwise fall back to upload order.
+    """
+
+    UPLOADED = 'uploaded'
+    TAKEN = 'taken'
+    RELEVANCE = 'relevance'
+
+    COLUMNS = {
+        UPLOADED:   'images.ts',
+        TAKEN:      'coalesce(images.create_ts, images.ts)',
+        RELEVANCE:  'images.ts'
+    }
+
+    @staticmethod
+    def value(sort, image):
+        """
+            The value an image is sorted by, as used in cursors.
+        """
+        if sort == SortOrder.TAKEN and image.create_timestamp is not None:
+            return str(image.create_timestamp)
+        return str(image.timestamp)
+
+#--------------------------------------------------------------------
+class QuerySyntaxError(ValueError):
+    pass
+
+#--------------------------------------------------------------------
+class TagTerm:
+    """
+        Matches images with the given tag.
+    """
+
+    def __init__(self, tag):
+        self.tag = tag
+
+    def __str__(self):
+        return self.tag
+
+    def __eq__(self, other):
+        return type(self) is type(other) and str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def terms(self):
+        yield self
+
+    def estimate(self, counts):
+        return counts.get(self, 0)
+
+    def condition(self):
+        return 'exists (select 1 from image_tags where tag = ? and id = images.id)', [self.tag]
+
+    def candidates(self):
+        """
+            A query for the distinct ids of exactly the images matching
+            this term, or None if there is no cheap way to list them.
+        """
+        return 'select id from image_tags where tag = ?', [self.tag]
+
+#--------------------------------------------------------------------
+class PrefixTerm(TagTerm):
+    """
+        Matches images with any tag matching a pattern, where '*'
+        matches any run of characters.  The text before the first '*'
+        bounds a range scan of the tag indexes, and the rest of the
+        pattern is checked with glob.
+    """
+
+    def __init__(self, pattern):
+        super().__init__(pattern)
+        self.prefix = pattern.split('*', 1)[0]
+        self.upper = self.prefix[:-1] + chr(ord(self.prefix[-1]) + 1) if self.prefix else None
+        self.regex = re.compile('.*'.join(re.escape(part) for part in pattern.split('*')) + r'\Z', re.S)
+        if pattern == self.prefix + '*':
+            self.glob = None
+        else:
+            self.glob = re.sub(r'[\[?]', lambda m: '[%s]' % m.group(0), pattern)
+
+    def matches(self, tag):
+        return self.regex.match(tag) is not None
+
+    def range_filter(self):
+        filters = []
+        params = []
+        if self.prefix:
+            filters.append('tag >= ? and tag < ?')
+            params.extend([self.prefix, self.upper])
+        if self.glob is not None:
+            filters.append('tag glob ?')
+            params.append(self.glob)
+        return ' and '.join(filters) or '1', params
+
+    def condition(self):
+        range_filter, params = self.range_filter()
+        return 'exists (select 1 from image_tags where id = images.id and %s)' % range_filter, params
+
+    def candidates(self):
+        range_filter, params = self.range_filter()
+        return 'select distinct id from image_tags where %s' % range_filter, params
+
+#--------------------------------------------------------------------
+class DateRangeTerm(TagTerm):
+    """
+        Matches images taken on or after the lower date and before the
+        upper date, using the create_ts index.  Dates are 'YYYY-MM-DD'
+        strings and either end may be open.  Images with no capture
+        date never match.
+    """
+
+    def __init__(self, lower = None, upper = None):
+        self.lower = lower
+        self.upper = upper
+
+    def __str__(self):
+        bounds = []
+        if self.lower is not None:
+            bounds.append('after:%s' % self.lower)
+        if self.upper is not None:
+            bounds.append('before:%s' % self.upper)
+        return bounds[0] if len(bounds) == 1 else '(%s)' % ' and '.join(bounds)
+
+    def intersect(self, other):
+        lower = max(d for d in (self.lower, other.lower, '') if d is not None) or None
+        upper = min(d for d in (self.upper, other.upper, '~') if d is not None)
+        return DateRangeTerm(lower, None if upper == '~' else upper)
+
+    def range_filter(self, column = 'create_ts'):
+        filters = []
+        params = []
+        if self.lower is not None:
+            filters.append('%s >= ?' % column)
+            params.append(self.lower)
+        if self.upper is not None:
+            filters.append('%s < ?' % column)
+            params.append(self.upper)
+        return ' and '.join(filters), params
+
+    def condition(self):
+        # Explicit about null so that a negated range matches undated images.
+        range_filter, params = self.range_filter('images.create_ts')
+        return '(images.create_ts is not null and %s)' % range_filter, params
+
+    def candidates(self):
+        range_filter, params = self.range_filter()
+        return 'select id from images where %s' % range_filter, params
+
+#--------------------------------------------------------------------
+class TextTerm(TagTerm):
+    """
+        Matches images whose summaries contain all of the given words,
+        using the image_text full-text index.  A word ending in '*'
+        matches any word starting with the rest of it.
+    """
+
+    def __init__(self, words):
+        self.words = tuple(sorted(set(words)))
+
+    def __str__(self):
+        return '"%s"' % ' '.join(self.words)
+
+    def match(self):
+        """
+            The words as an FTS5 query, with each word quoted so that
+            it can't be read as an FTS5 operator.
+        """
+        return ' '.join('"%s"*' % word[:-1] if word.endswith('*') else '"%s"' % word
+                        for word in self.words)
+
+    def condition(self):
+        return 'images.rowid in (select rowid from image_text where image_text match ?)', [self.match()]
+
+    def candidates(self):
+        return ('select images.id from image_text cross join images on images.rowid = image_text.rowid '
+                'where image_text match ?'), [self.match()]
+
+#--------------------------------------------------------------------
+class NotTerm(TagTerm):
+    """
+        Matches images not matching its child.
+    """
+
+    def __init__(self, child):
+        self.child = child
+
+    def __str__(self):
+        return '-%s' % self.child
+
+    def terms(self):
+        return self.child.terms()
+
+    def estimate(self, counts):
+        return None
+
+    def condition(self):
+        condition, params = self.child.condition()
+        return 'not %s' % condition, params
+
+    def candidates(self):
+        return None
+
+#--------------------------------------------------------------------
+class AndTerm(TagTerm):
+    """
+        Matches images matching all of its children.  With no children
+        it matches every image.
+    """
+
+    OPERATOR = 'and'
+
+    def __init__(self, children):
+        self.children = children
+
+    def __str__(self):
+        return '(%s)' % (' %s ' % self.OPERATOR).join(str(child) for child in self.children)
+
+    def terms(self):
+        for child in self.children:
+            yield from child.terms()
+
+    def estimate(self, counts):
+        estimates = [child.estimate(counts) for child in self.children]
+        estimates = [n for n in estimates if n is not None]
+        return min(estimates) if estimates else None
+
+    def condition(self):
+        if not self.children:
+            return '1', []
+        conditions, params = self._combine(child.condition() for child in self.children)
+        return '(%s)' % (' %s ' % self.OPERATOR).join(conditions), params
+
+    def candidates(self):
+        return None
+
+    def _combine(self, compiled):
+        conditions, params = [], []
+        for condition, condition_params in compiled:
+            conditions.append(condition)
+            params.extend(condition_params)
+        return conditions, params
+
+#--------------------------------------------------------------------
+class OrTerm(AndTerm):
+    """
+        Matches images matching any of its children.
+    """
+
+    OPERATOR = 'or'
+
+    def estimate(self, counts):
+        estimates = [child.estimate(counts) for child in self.children]
+        if None in estimates:
+            return None
+        return sum(estimates)
+
+    def candidates(self):
+        compiled = [child.candidates() for child in self.children]
+        if None in compiled:
+            return None
+        candidates, params = self._combine(compiled)
+        return ' union '.join(candidates), params
+
+#--------------------------------------------------------------------
+def make_term(cls, children):
+    """
+        Flatten nested terms of the same kind, drop duplicates and
+        order children canonically, so that equivalent queries share
+        cache entries.
+    """
+    flattened = {}
+    date_range = None
+    words = []
+    for child in children:
+        for grandchild in (child.children if type(child) is cls else [child]):
+            if cls is AndTerm and type(grandchild) is DateRangeTerm:
+                # Date bounds which must all hold are a single range.
+                date_range = grandchild if date_range is None else date_range.intersect(grandchild)
+            elif cls is AndTerm and type(grandchild) is TextTerm:
+                # Likewise words which must all appear are a single search.
+                words.extend(grandchild.words)
+            else:
+                flattened[str(grandchild)] = grandchild
+    for term in (date_range, TextTerm(words) if words else None):
+        if term is not None:
+            flattened[str(term)] = term
+    if len(flattened) == 1:
+        return next(iter(flattened.values()))
+    return cls([flattened[key] for key in sorted(flattened)])
+
+#--------------------------------------------------------------------
+class QueryParser:
+    """
+        Parses search queries.  Terms are separated by whitespace and
+        all must match, 'or' (or '|') between terms matches either of
+        them, and 'or' binds tighter than the implicit 'and':
+
+            public (date:2016 or date:2017) -user:guest date:*-2016
+
+        A leading '-' excludes a term or group, and '*' in a term
+        matches any run of characters.  'after:' and 'before:' take a
+        YYYY, YYYY-MM or YYYY-MM-DD date and match images taken from
+        the start of that date on, or before it.  Words in double
+        quotes are searched for in image summaries:
+
+            "beach trip" public -"sunburn"
+    """
+
+    MAX_TERMS = 16
+    MAX_DEPTH = 8
+
+    TOKEN_REGEX = re.compile(r'"[^"]*"?|\(|\)|[^\s()"]+')
+    DATE_REGEX = re.compile(r'(after|before):(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?\Z')
+
+    def parse(self, text):
+        self.tokens = QueryParser.TOKEN_REGEX.findall(text)
+        self.pos = 0
+        self.term_count = 0
+        self.depth = 0
+        query = self._parse_and()
+        if self.pos < len(self.tokens):
+            raise QuerySyntaxError('Unexpected "%s" in query.' % self.tokens[self.pos])
+        return query
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _is_or(self, token):
+        return token is not None and token.lower() in ('or', '|')
+
+    def _parse_and(self):
+        children = []
+        while self._peek() not in (None, ')'):
+            children.append(self._parse_or())
+        return make_term(AndTerm, children) if children else AndTerm([])
+
+    def _parse_or(self):
+        children = [self._parse_unary()]
+        while self._is_or(self._peek()):
+            self.pos += 1
+            if self._peek() in (None, ')'):
+                raise QuerySyntaxError('Expected a term after "or".')
+            children.append(self._parse_unary())
+        return make_term(OrTerm, children)
+
+    def _parse_unary(self):
+        token = self._peek()
+        if token == '-':
+            self.pos += 1
+            if self._peek() in (None, ')'):
+                raise QuerySyntaxError('Expected a term after "-".')
+            return NotTerm(self._parse_unary())
+        if token.startswith('-'):
+            self.tokens[self.pos] = token[1:]
+            return NotTerm(self._parse_unary())
+        if token == '(':
+            self.pos += 1
+            self.depth += 1
+            if self.depth > QueryParser.MAX_DEPTH:
+                raise QuerySyntaxError('Queries may be nested at most %d deep.' % QueryParser.MAX_DEPTH)
+            group = self._parse_and()
+            if self._peek() != ')':
+                raise QuerySyntaxError('Missing ")" in query.')
+            self.pos += 1
+            self.depth -= 1
+            return group
+        if self._is_or(token):
+            raise QuerySyntaxError('Expected a term before "or".')
+        return self._parse_term(token)
+
+    def _parse_term(self, token):
+        self.pos += 1
+        self.term_count += 1
+        if self.term_count > QueryParser.MAX_TERMS:
+            raise QuerySyntaxError('Queries may have at most %d terms.' % QueryParser.MAX_TERMS)
+        if token.startswith('"'):
+            return self._parse_text(token)
+        tag = normalize_tag(token)
+        match = QueryParser.DATE_REGEX.match(tag)
+        if match:
+            return self._parse_date(token, *match.groups())
+        if not tag.strip('*'):
+            raise QuerySyntaxError('"%s" would match every tag.' % token)
+        if '*' in tag:
+            return PrefixTerm(re.sub(r'\*+', '*', tag))
+        return TagTerm(tag)
+
+    def _parse_date(self, token, operator, year, month, day):
+        try:
+            date = datetime.date(int(year), int(month or 1), int(day or 1)).isoformat()
+        except ValueError:
+            raise QuerySyntaxError('"%s" is not a valid date.' % token)
+        if operator == 'after':
+            return DateRangeTerm(lower = date)
+        return DateRangeTerm(upper = date)
+
+    def _parse_text(self, token):
+        if len(token) < 2 or not token.endswith('"'):
+            raise QuerySyntaxError('Missing closing quote in query.')
+        words = [re.sub(r'\*+$', '*', normalize_tag(word)) for word in token[1:-1].split()]
+        words = [word for word in words if re.search(r'\w', word)]
+        if not words:
+            raise QuerySyntaxError('%s has no words to search for.' % token)
+        return TextTerm(words)
+
+#--------------------------------------------------------------------
+@functools.lru_cache(maxsize = 256)
+def parse_query(text):
+    """
+        Parse a search query into a tree of terms, see QueryParser.
+        Raises QuerySyntaxError for invalid queries.
+    """
+    return QueryParser().parse(text)
+
+#--------------------------------------------------------------------
+def tag_list_query(tags, ntags = ()):
+    """
+        Build a query matching images with all of the given tags and
+        none of the excluded ones.
+    """
+    children = [TagTerm(tag) for tag in normalize_tags(tags)]
+    children.extend(NotTerm(TagTerm(tag)) for tag in normalize_tags(ntags))
+    return make_term(AndTerm, children) if children else AndTerm([])
+
+#--------------------------------------------------------------------
+class TagQueryCompiler:
+    """
+        Compiles a parsed query into a single SQL statement which
+        returns a page of image ids along with the total number of
+        matching images.  The candidate images are drawn from the
+        tag indexes for the most selective part of the query, chosen
+        using the tag_stats table, and then filtered by the whole
+        query.  Results sorted by relevance are instead drawn from the
+        full-text index in rank order.
+
+        Tags and other values are always bound as parameters, so the
+        SQL text depends only on the shape of the query and the chosen
+        plan.  Prepared statements are reused per shape by the sqlite3
+        statement cache of each connection, see STATEMENT_CACHE_SIZE in
+        db.py.  Building the SQL text again takes tens of microseconds.
+    """
+
+    def get_counts(self, c, query):
+        """
+            Look up the number of images matching each tag, pattern,
+            date range and text search in the query.
+        """
+        counts = {}
+        terms = set(query.terms())
+        tags = [term.tag for term in terms if type(term) is TagTerm]
+        if tags:
+            c.execute('select tag, image_count from tag_stats where tag in (%s)' % ','.join('?' * len(tags)), tags)
+            counts.update((TagTerm(tag), image_count) for tag, image_count in c.fetchall())
+        for term in terms:
+            if type(term) is PrefixTerm:
+                range_filter, params = term.range_filter()
+                c.execute('select coalesce(sum(image_count), 0) from tag_stats where %s' % range_filter, params)
+                counts[term] = c.fetchone()[0]
+            elif type(term) is DateRangeTerm:
+                range_filter, params = term.range_filter()
+                c.execute('select count(*) from images where %s' % range_filter, params)
+                counts[term] = c.fetchone()[0]
+            elif type(term) is TextTerm:
+                c.execute('select count(*) from image_text where image_text match ?', [term.match()])
+                counts[term] = c.fetchone()[0]
+        return counts
+
+    def ranked_term(self, query, sort):
+        """
+            The text search which results are ranked by, or None if the
+            results are not sorted by relevance.  Text searches which
+            are only one of several alternatives can't be ranked.
+        """
+        if sort != SortOrder.RELEVANCE:
+            return None
+        for term in (query.children if type(query) is AndTerm else [query]):
+            if type(term) is TextTerm:
+                return term
+        return None
+
+    def compile_select(self, query, counts, sort = SortOrder.UPLOADED):
+        ranked = self.ranked_term(query, sort)
+        source, condition, params = self._compile_plan(query, counts, ranked)
+        if ranked is not None:
+            order = 'image_text.rank, images.id'
+        else:
+            order = '%s desc, images.id' % SortOrder.COLUMNS[sort]
+        sql = ('select images.id, count(*) over () from {source} where {condition} '
+               'order by {order} limit ? offset ?').format(
+            source = source, condition = condition, order = order)
+        return sql, params
+
+    def compile_keyset_select(self, query, counts, direction, sort = SortOrder.UPLOADED):
+        """
+            Compile a page query positioned by a cursor rather than an
+            offset.  'before' and 'last' pages are selected in ascending
+            order and must be reversed by the caller.  Ranked results
+            have no cursors, see ranked_term.
+        """
+        if direction == Cursor.AFTER:
+            keyset = '({ts} < ? or ({ts} = ? and images.id > ?))'
+            order = '{ts} desc, images.id'
+        elif direction == Cursor.BEFORE:
+            keyset = '({ts} > ? or ({ts} = ? and images.id < ?))'
+            order = '{ts}, images.id desc'
+        else:
+            keyset = '1'
+            order = '{ts}, images.id desc'
+
+        ts = SortOrder.COLUMNS[sort]
+        source, condition, params = self._compile_plan(query, counts)
+        sql = ('select images.id from {source} where {condition} and {keyset} '
+               'order by {order} limit ? offset ?').format(
+            source = source, condition = condition,
+            keyset = keyset.format(ts = ts), order = order.format(ts = ts))
+        return sql, params
+
+    def compile_count(self, query, counts):
+        source, condition, params = self._compile_plan(query, counts)
+        sql = 'select count(*) from {source} where {condition}'.format(
+            source = source, condition = condition)
+        return sql, params
+
+    def page_params(self, limit, offset, cursor = None):
+        params = []
+        if cursor is not None and cursor.direction != Cursor.LAST:
+            params += [cursor.ts, cursor.ts, cursor.id]
+        return params + [limit, offset]
+
+    def _compile_plan(self, query, counts, driver = None):
+        """
+            Choose where candidate images come from: the whole query if
+            its matches can be listed from the indexes, otherwise the
+            most selective such part of a conjunction, unless a driver
+            is given.  Only the rest of the query is then checked per
+            candidate.
+        """
+        if driver is None and query.candidates() is not None:
+            driver = query
+        elif driver is None and type(query) is AndTerm:
+            for child in query.children:
+                if child.candidates() is not None and (
+                        driver is None or child.estimate(counts) < driver.estimate(counts)):
+                    driver = child
+
+        rest = query
+        if driver is query:
+            rest = AndTerm([])
+        elif driver is not None:
+            rest = AndTerm([child for child in query.children if child is not driver])
+
+        if type(driver) is DateRangeTerm:
+            # A date range is read straight from the create_ts index.
+            range_filter, range_params = driver.range_filter('images.create_ts')
+            condition, params = rest.condition()
+            return 'images indexed by image_create_ts_idx', '%s and %s' % (range_filter, condition), range_params + params
+
+        if type(driver) is TextTerm:
+            # Joined directly so that the match's rank can be ordered by.
+            condition, params = rest.condition()
+            return ('image_text cross join images on images.rowid = image_text.rowid',
+                    'image_text match ? and %s' % condition, [driver.match()] + params)
+
+        condition, params = rest.condition()
+        if driver is None:
+            return 'images', condition, params
+
+        # The cross join keeps sqlite from reordering the join.
+        candidates, candidate_params = driver.candidates()
+        source = '(%s) as included cross join images on images.id = included.id' % candidates
+        return source, condition, candidate_params + params
+
+#--------------------------------------------------------------------
+tag_query_compiler = TagQueryCompiler()
@@ -39,8 +39,8 @@ class JennaBoxServer:
 
     @cherrypy.expose
     @render
-    def search(self, query, page = 0):
-        return ImageSearchPage(query, page)
+    def search(self, query, page = 1, cursor = None, sort = None):
+        return ImageSearchPage(query, page, cursor, sort)
 
     @cherrypy.expose
     @render
@@ -57,9 +57,9 @@ class JennaBoxServer:
     @require(UserRight.UPLOAD)
     def upload_post(self, image_file, summary, tags):
         user = self.auth.get_user()
-        user_tag = 'user:%s' % user.username
         image_dao = self.dao_factory.get_image_dao()
-        image = image_dao.save_new_image(image_file, summary, json.loads(tags) + [user_tag])
+        image = image_dao.save_new_image(image_file, summary,
+                                         normalize_tags(json.loads(tags) + [user.get_tag()]))
         raise cherrypy.HTTPRedirect('/view?id=%s' % image.id)
 
     @cherrypy.expose
@@ -84,7 +84,7 @@ class JennaBoxServer:
             raise AccessDenied('User "%s" is not allowed to edit image with id "%s".' % (
                 user.username, image.id))
 
-        image.tags = set(json.loads(tags))
+        image.tags = normalize_tags(json.loads(tags))
         image.summary = summary
         image_dao.save_image(image)
         raise cherrypy.HTTPRedirect('/view?id=%s' % image.id)
@@ -119,6 +119,12 @@ class JennaBoxServer:
         else:
             raise cherrypy.HTTPRedirect('/')
 
+    @cherrypy.expose
+    @require(UserRight.ADMIN)
+    def metrics(self):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(self.injector.require('metrics').snapshot(), indent = 4)
+
     @cherrypy.expose
     @render
     def images(self, filename):
@@ -131,6 +137,7 @@ def main():
     #injector.require('admin_user')
 
     server = injector.create(JennaBoxServer)
+    injector.require('dao_factory').get_image_dao().resume_processing()
     server.start()
 
 #--------------------------------------------------------------------